@@ -12,8 +12,20 @@
 #####################################################################
 import sys
 import time
-import zprocess
+import json
+import queue
+import collections
+import tempfile
+import threading
+import traceback
+from binascii import hexlify
+from socket import gethostbyname
+import os
+import zmq
+from zprocess.security import SecureContext
+from zprocess.utils import raise_exception_in_thread
 import labscript_utils.shared_drive
+from labscript_utils.ls_zprocess import ZMQServer, get_config
 # importing this wraps zlock calls around HDF file openings and closings:
 import labscript_utils.h5_lock
 import h5py
@@ -70,43 +82,818 @@ import numpy as np
 #   OR, if exception encountered calling self.abort(), camera server responds
 #       with the exception text.
 #
+# status, can occur at any time:
+#   Client sends 'status'
+#   CameraServer responds with its state, one of 'idle', 'transition_to_buffered',
+#       'buffered', 'transition_to_static' or 'abort', followed by ': <progress>'
+#       if the method being run has called self.report_progress(<progress>).
+#
+# By default the camera server handles one request at a time, and so cannot respond
+# to pings or aborts whilst a transition is in progress. If instantiated with
+# concurrent=True, transitions and aborts instead run in order on a worker thread,
+# whilst the server continues responding to pings and status requests. The reply
+# to BLACS's empty string is then sent once the transition is complete, so the
+# protocol as seen by BLACS is unchanged. An abort received during a transition
+# sets self.abort_requested, which long-running transitions may check in order to
+# finish early, and then calls self.abort() once the transition is complete.
+#
+# If instantiated with a frames_port, the camera server additionally publishes frames
+# passed to self.publish_frame() on that port, as raw buffers with a JSON header
+# describing their dtype and shape. If also given a frame_ring, a SharedFrameRing,
+# frames are instead passed through shared memory, for consumers on the same
+# computer, and only their headers are sent. See FramePublisher and FrameSubscriber.
 
-class CameraServer(zprocess.ZMQServer):
-    def __init__(self, port):
-           zprocess.ZMQServer.__init__(self, port, type='string')
-           self._h5_filepath = None
 
-    def handler(self, request_data):
+class FrameBuffer(object):
+    """Buffers images in a temporary HDF5 file as they arrive during a shot, writing
+    them from a background thread, so that at the end of the shot they can be copied
+    into the shot file quickly, minimising the time for which the shot file (and its
+    zlock) is held open. Datasets are written to the temporary file with the final
+    compression and chunking, and are copied into the shot file without being
+    decompressed and recompressed.
+
+    Args:
+        compression (str, optional): HDF5 compression filter for datasets, such as
+            'gzip' or 'lzf', or None for no compression.
+        compression_opts (optional): Options for the compression filter, such as the
+            gzip compression level.
+        shuffle (bool, optional): Whether to use the HDF5 shuffle filter, which often
+            improves compression of image data.
+        chunk_frames (int, optional): Number of frames per chunk of datasets created
+            with add_frame().
+        max_queued (int, optional): Maximum number of images waiting to be written to
+            the temporary file. add_frame() and add_image() block if this many are
+            waiting.
+
+    If writing to the temporary file fails, the background thread stops, and
+    add_frame(), add_image() and save() raise the exception, until discard() is called.
+        temp_dir (str, optional): Directory for the temporary file, by default the
+            system temporary directory.
+    """
+
+    # How often to check that the writer thread is still running when waiting for space
+    # in the queue:
+    _POLL_INTERVAL = 0.1
+
+    def __init__(
+        self,
+        compression=None,
+        compression_opts=None,
+        shuffle=False,
+        chunk_frames=1,
+        max_queued=64,
+        temp_dir=None,
+    ):
+        self.dataset_kwargs = {
+            'compression': compression,
+            'compression_opts': compression_opts,
+            'shuffle': shuffle,
+        }
+        self.chunk_frames = chunk_frames
+        self.temp_dir = temp_dir
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._thread = None
+        self._temp_filepath = None
+        self._error = None
+        self.n_queued = 0
+        self.n_images = 0
+        self.n_bytes = 0
+
+    def _start(self):
+        fd, self._temp_filepath = tempfile.mkstemp(suffix='.h5', dir=self.temp_dir)
+        os.close(fd)
+        self._thread = threading.Thread(target=self._writer, daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        if self._thread is None:
+            self._start()
+        # Wait for space in the queue, but not forever if the writer thread has stopped:
+        while True:
+            if self._error is not None:
+                raise self._error
+            if not self._thread.is_alive():
+                raise RuntimeError('FrameBuffer writer thread is not running')
+            try:
+                self._queue.put(item, timeout=self._POLL_INTERVAL)
+                break
+            except queue.Full:
+                continue
+        self.n_queued += 1
+
+    def add_frame(self, name, frame):
+        """Append a frame to the dataset with the given name (a path relative to the
+        group the images will be saved to), which will be a stack of all frames added
+        with this name. The frame is copied, so the caller may reuse its buffer."""
+        self._put(('frame', name, np.array(frame)))
+
+    def add_image(self, name, image):
+        """Save an image as its own dataset with the given name (a path relative to the
+        group the images will be saved to). The image is copied, so the caller may
+        reuse its buffer."""
+        self._put(('image', name, np.array(image)))
+
+    def _writer(self):
+        # The temporary file is private to this process, so open it with the h5py
+        # File class that does not acquire a zlock:
+        try:
+            with labscript_utils.h5_lock._File(self._temp_filepath, 'w') as f:
+                while True:
+                    item = self._queue.get()
+                    if item is None:
+                        break
+                    kind, name, data = item
+                    self._write(f, kind, name, data)
+                    self.n_images += 1
+                    self.n_bytes += data.nbytes
+        except Exception as e:
+            # Stop, leaving _put() and save() to raise the exception:
+            self._error = e
+
+    def _write(self, f, kind, name, data):
+        if kind == 'image':
+            f.create_dataset(
+                name, data=data, chunks=data.shape or None, **self.dataset_kwargs
+            )
+            return
+        dataset = f.get(name)
+        if dataset is None:
+            dataset = f.create_dataset(
+                name,
+                shape=(0,) + data.shape,
+                maxshape=(None,) + data.shape,
+                dtype=data.dtype,
+                chunks=(self.chunk_frames,) + data.shape,
+                **self.dataset_kwargs
+            )
+        n_frames = dataset.shape[0]
+        dataset.resize(n_frames + 1, axis=0)
+        dataset[n_frames] = data
+
+    def _finish_writing(self):
+        if self._thread is not None:
+            # Tell the writer thread to stop, unless it already has after an error:
+            while self._thread.is_alive():
+                try:
+                    self._queue.put(None, timeout=self._POLL_INTERVAL)
+                    break
+                except queue.Full:
+                    continue
+            self._thread.join()
+            self._thread = None
+            # Remove any images left unwritten by a writer thread that stopped early:
+            while True:
+                try:
+                    self._queue.get_nowait()
+                except queue.Empty:
+                    break
+
+    def save(self, h5_filepath, group='/'):
+        """Wait for all images to be written to the temporary file, then copy them into
+        the given group of the HDF5 file, and delete the temporary file. Returns a dict
+        with the number of images and bytes saved, the time spent waiting for the
+        background writes to complete ('write_time'), and the time for which the shot
+        file was open ('copy_time')."""
+        start_time = time.perf_counter()
+        try:
+            self._finish_writing()
+            if self._error is not None:
+                raise self._error
+            write_time = time.perf_counter() - start_time
+            start_time = time.perf_counter()
+            if self._temp_filepath is not None:
+                with labscript_utils.h5_lock._File(self._temp_filepath, 'r') as src:
+                    with h5py.File(h5_filepath, 'r+') as f:
+                        dest = f.require_group(group)
+                        for name in src:
+                            src.copy(src[name], dest, name=name)
+            copy_time = time.perf_counter() - start_time
+            return {
+                'n_images': self.n_images,
+                'n_bytes': self.n_bytes,
+                'write_time': write_time,
+                'copy_time': copy_time,
+            }
+        finally:
+            self.discard()
+
+    def discard(self):
+        """Discard all images and delete the temporary file"""
+        self._finish_writing()
+        if self._temp_filepath is not None:
+            try:
+                os.unlink(self._temp_filepath)
+            except OSError:
+                pass
+            self._temp_filepath = None
+        self._error = None
+        self.n_queued = 0
+        self.n_images = 0
+        self.n_bytes = 0
+
+
+class FrameOverrun(Exception):
+    """Raised when a frame in a SharedFrameRing was overwritten before it could be
+    read"""
+
+
+class SharedFrameRing(object):
+    """A ring buffer of fixed-size frame slots in shared memory, for passing frames to
+    consumers on the same computer without copying them through a socket. The writer
+    writes each frame into the next slot, and announces its slot, sequence number,
+    dtype and shape to readers by some other means, such as a FramePublisher. Readers
+    attach to the ring by name. Each slot records the sequence number of the frame in
+    it, so that readers can detect when a frame was overwritten before or whilst they
+    read it.
+
+    Args:
+        n_slots (int): Number of frame slots.
+        slot_size (int): Size of each slot in bytes, the largest frame that can be
+            stored.
+        name (str, optional): Name of the shared memory block to create, by default
+            a random name.
+    """
+
+    # The first _HEADER_SIZE bytes contain the number of slots and the slot size.
+    # Each slot then begins with _HEADER_SIZE bytes containing the sequence number of
+    # the frame in it, followed by the frame data:
+    _HEADER_SIZE = 64
+    _WRITING = -1
+    # Names of the rings created by this process and not yet closed:
+    _created_names = set()
+
+    def __init__(self, n_slots, slot_size, name=None, _shm=None):
+        from multiprocessing import shared_memory
+
+        self.n_slots = n_slots
+        self.slot_size = slot_size
+        self._stride = self._HEADER_SIZE + -(-slot_size // 64) * 64
+        self._owner = _shm is None
+        if _shm is None:
+            size = self._HEADER_SIZE + n_slots * self._stride
+            _shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+            np.ndarray(2, np.int64, _shm.buf)[:] = n_slots, slot_size
+            self._created_names.add(_shm.name)
+        self.shm = _shm
+        self.name = _shm.name
+        self._sequences = []
+        for slot in range(n_slots):
+            offset = self._HEADER_SIZE + slot * self._stride
+            self._sequences.append(np.ndarray(1, np.int64, _shm.buf, offset))
+            if self._owner:
+                self._sequences[slot][0] = self._WRITING
+
+    @classmethod
+    def attach(cls, name, untrack=None):
+        """Attach to an existing ring, usually one created by another process.
+
+        On Python < 3.13, attaching registers the shared memory with the resource
+        tracker, which would destroy it when this process exits. So unless the ring was
+        created by this process, the registration is removed. Pass untrack=False if the
+        ring was created by a process sharing our resource tracker, such as a
+        multiprocessing parent, since otherwise this also removes the creator's
+        registration, and the tracker prints a KeyError when the ring is destroyed."""
+        from multiprocessing import shared_memory
+
+        try:
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # Python < 3.13:
+            shm = shared_memory.SharedMemory(name=name)
+            if untrack is None:
+                untrack = shm.name not in cls._created_names
+            if untrack and os.name != 'nt':
+                from multiprocessing import resource_tracker
+
+                resource_tracker.unregister(shm._name, 'shared_memory')
+        n_slots, slot_size = np.ndarray(2, np.int64, shm.buf)
+        return cls(int(n_slots), int(slot_size), _shm=shm)
+
+    def _slot_data(self, slot, nbytes):
+        offset = self._HEADER_SIZE + slot * self._stride + self._HEADER_SIZE
+        return np.ndarray(nbytes, np.uint8, self.shm.buf, offset)
+
+    def write(self, frame, sequence):
+        """Copy a frame into the slot for the given sequence number, and return the
+        slot index."""
+        frame = np.ascontiguousarray(frame)
+        if frame.nbytes > self.slot_size:
+            msg = 'Frame of %d bytes does not fit in slot of %d bytes'
+            raise ValueError(msg % (frame.nbytes, self.slot_size))
+        slot = sequence % self.n_slots
+        self._sequences[slot][0] = self._WRITING
+        self._slot_data(slot, frame.nbytes)[:] = frame.reshape(-1).view(np.uint8)
+        self._sequences[slot][0] = sequence
+        return slot
+
+    def is_valid(self, slot, sequence):
+        """Return whether the given slot still contains the frame with the given
+        sequence number"""
+        return self._sequences[slot][0] == sequence
+
+    def read(self, slot, sequence, dtype, shape, copy=True):
+        """Return the frame with the given sequence number from the given slot. If copy
+        is False, the returned array is a view of the shared memory, and the caller
+        should check with is_valid() after using it that it was not overwritten in the
+        meantime. Such views keep the shared memory mapped, even after close(), until
+        they are garbage collected. Raises FrameOverrun if the frame has already
+        been overwritten."""
+        if not self.is_valid(slot, sequence):
+            raise FrameOverrun('Frame %d overwritten before being read' % sequence)
+        dtype = np.dtype(dtype)
+        nbytes = dtype.itemsize * int(np.prod(shape))
+        frame = self._slot_data(slot, nbytes).view(dtype).reshape(shape)
+        if copy:
+            frame = frame.copy()
+            if not self.is_valid(slot, sequence):
+                raise FrameOverrun('Frame %d overwritten whilst being read' % sequence)
+        return frame
+
+    def close(self):
+        """Detach from the shared memory, and if we created it, destroy it. Arrays
+        returned by read() with copy=False remain valid: the memory is unmapped only
+        once they have all been garbage collected, though if we created it, no other
+        processes can attach to it after this."""
+        self._sequences = None
+        # Arrays returned by read(copy=False) reference the mmap of the shared memory,
+        # but without preventing it from being closed, after which accessing them would
+        # crash. So rather than closing the mmap, drop our references to it, and it is
+        # unmapped once nothing else references it either:
+        self.shm._buf = None
+        self.shm._mmap = None
+        self.shm.close()
+        if self._owner:
+            self.shm.unlink()
+            self._created_names.discard(self.name)
+
+
+class FramePublisher(object):
+    """Publishes frames on a zmq PUB socket as raw buffers, without copying them, for
+    live-view clients and the like to receive with a FrameSubscriber. Each message has
+    three frames: a topic, being the frame name followed by a null byte, a utf-8
+    encoded JSON header with the frame's 'name', 'dtype', 'shape', sequence number
+    'seq' and publication 'time', plus any additional metadata, and the frame data.
+
+    Frames are sent from a background thread. If frames are published faster than
+    they can be sent, the oldest unsent frames are dropped. Subscribers falling behind
+    also lose frames, which they can detect from gaps in the sequence numbers.
+
+    If a SharedFrameRing is given, frames are instead copied into it, and the message
+    contains only the topic and header, which additionally has the ring's name as
+    'shm' and the frame's 'slot'. Such frames can only be received by subscribers on
+    the same computer. Frames too large for the ring's slots are sent as usual.
+
+    Args:
+        port (int, optional): Port to bind to, or None for a random port, which will be
+            available as the port attribute.
+        max_queued (int, optional): Maximum number of frames waiting to be sent before
+            the oldest is dropped.
+        bind_address (str, optional): Address to bind to.
+        ring (SharedFrameRing, optional): Shared memory to pass frames through.
+    """
+
+    def __init__(self, port=None, max_queued=4, bind_address='tcp://*', ring=None):
+        # Secured with the shared secret from labconfig, like ls_zprocess.ZMQServer:
+        config = get_config()
+        self.context = SecureContext.instance(shared_secret=config['shared_secret'])
+        self.sock = self.context.socket(
+            zmq.PUB, allow_insecure=config['allow_insecure']
+        )
+        self.sock.setsockopt(zmq.LINGER, 0)
+        self.sock.setsockopt(zmq.SNDHWM, max_queued)
+        if port is None:
+            self.port = self.sock.bind_to_random_port(bind_address)
+        else:
+            self.sock.bind('%s:%d' % (bind_address, port))
+            self.port = port
+        self.ring = ring
+        self.sequence = 0
+        self.n_dropped = 0
+        self._frames = collections.deque(maxlen=max_queued)
+        self._condition = threading.Condition()
+        self._stopping = False
+        self._thread = threading.Thread(target=self._sender, daemon=True)
+        self._thread.start()
+
+    def publish(self, name, frame, **metadata):
+        """Queue a frame to be sent, along with any JSON-serialisable metadata. The
+        frame's memory is sent without being copied, so it must not be modified
+        afterward."""
+        frame = np.ascontiguousarray(frame)
+        with self._condition:
+            header = {
+                'name': name,
+                'dtype': frame.dtype.str,
+                'shape': frame.shape,
+                'seq': self.sequence,
+                'time': time.time(),
+            }
+            header.update(metadata)
+            if self.ring is not None and frame.nbytes <= self.ring.slot_size:
+                header['shm'] = self.ring.name
+                header['slot'] = self.ring.write(frame, self.sequence)
+                frame = None
+            self.sequence += 1
+            if len(self._frames) == self._frames.maxlen:
+                self.n_dropped += 1
+            self._frames.append((name, header, frame))
+            self._condition.notify()
+
+    def _sender(self):
+        while True:
+            with self._condition:
+                while not self._frames and not self._stopping:
+                    self._condition.wait()
+                if self._stopping:
+                    break
+                name, header, frame = self._frames.popleft()
+            messages = [name.encode('utf8') + b'\0', json.dumps(header).encode('utf8')]
+            if frame is not None:
+                messages.append(memoryview(frame).cast('B'))
+            self.sock.send_multipart(messages, copy=False)
+
+    def close(self):
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        self._thread.join()
+        self.sock.close(linger=0)
+
+
+class FrameSubscriber(object):
+    """Receives frames published by a FramePublisher, such as that of a CameraServer
+    with a frames_port. Frames are received in a background thread, and if recv() is
+    not called often enough to keep up, the oldest frames are dropped. Frames passed
+    through shared memory are read from it, and frames overwritten before they could
+    be read are skipped, and counted in n_overruns.
+
+    Args:
+        host (str): Host of the publisher.
+        port (int): Port of the publisher.
+        names (list, optional): Names of frames to receive, or None for all.
+        max_queued (int, optional): Maximum number of received frames waiting for
+            recv() to be called before the oldest is dropped.
+    """
+
+    def __init__(self, host, port, names=None, max_queued=4):
+        config = get_config()
+        self.context = SecureContext.instance(shared_secret=config['shared_secret'])
+        self.sock = self.context.socket(
+            zmq.SUB, allow_insecure=config['allow_insecure']
+        )
+        self.sock.setsockopt(zmq.LINGER, 0)
+        if names is None:
+            self.sock.setsockopt(zmq.SUBSCRIBE, b'')
+        else:
+            for name in names:
+                self.sock.setsockopt(zmq.SUBSCRIBE, name.encode('utf8') + b'\0')
+        self.sock.connect('tcp://%s:%d' % (gethostbyname(host), port))
+        self.n_dropped = 0
+        self.n_overruns = 0
+        self._rings = {}
+        self._frames = collections.deque(maxlen=max_queued)
+        self._condition = threading.Condition()
+        self._stopping = False
+        self._thread = threading.Thread(target=self._receiver, daemon=True)
+        self._thread.start()
+
+    def _receiver(self):
+        while not self._stopping:
+            # Poll with a timeout so that we notice when we are closed:
+            if not self.sock.poll(100):
+                continue
+            messages = self.sock.recv_multipart(copy=False)
+            with self._condition:
+                if len(self._frames) == self._frames.maxlen:
+                    self.n_dropped += 1
+                self._frames.append(messages)
+                self._condition.notify()
+
+    def recv(self, timeout=None, latest=True, copy=True):
+        """Return (header, frame) for the next frame. If latest is True, older frames
+        already received are discarded and the most recent is returned. Raises
+        TimeoutError if no frame arrives within timeout seconds.
+
+        Frames sent over the socket are returned as arrays backed by the received
+        message, without copying. Frames passed through shared memory are copied out
+        of it unless copy is False, in which case the returned array is a view of the
+        shared memory. The caller should then call is_valid(header) after using it, to
+        check it was not overwritten in the meantime."""
+        remaining = timeout
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        while True:
+            if timeout is not None:
+                remaining = max(0, deadline - time.monotonic())
+            with self._condition:
+                if not self._condition.wait_for(lambda: self._frames, remaining):
+                    raise TimeoutError('No frame received within %s s' % timeout)
+                if latest:
+                    self.n_dropped += len(self._frames) - 1
+                    messages = self._frames.pop()
+                    self._frames.clear()
+                else:
+                    messages = self._frames.popleft()
+            header = json.loads(bytes(messages[1].buffer))
+            if 'shm' not in header:
+                frame = np.frombuffer(messages[2].buffer, dtype=header['dtype'])
+                return header, frame.reshape(header['shape'])
+            ring = self._get_ring(header['shm'])
+            try:
+                slot, sequence = header['slot'], header['seq']
+                frame = ring.read(slot, sequence, header['dtype'], header['shape'], copy)
+            except FrameOverrun:
+                self.n_overruns += 1
+                continue
+            return header, frame
+
+    def _get_ring(self, name):
+        try:
+            return self._rings[name]
+        except KeyError:
+            ring = self._rings[name] = SharedFrameRing.attach(name)
+            return ring
+
+    def is_valid(self, header):
+        """Return whether a frame received with copy=False has not since been
+        overwritten. Always True for frames not passed through shared memory."""
+        if 'shm' not in header:
+            return True
+        return self._get_ring(header['shm']).is_valid(header['slot'], header['seq'])
+
+    def close(self):
+        self._stopping = True
+        self._thread.join()
+        self.sock.close(linger=0)
+        for ring in self._rings.values():
+            ring.close()
+        self._rings.clear()
+
+
+class CameraServer(ZMQServer):
+    # Group of the shot file to save images to that were added with add_frame() or
+    # add_image(), and keyword arguments for the FrameBuffer used to buffer them:
+    frames_group = 'images'
+    frame_buffer_options = {}
+
+    def __init__(self, port, concurrent=False, frames_port=None, frame_ring=None):
+        self._h5_filepath = None
+        self.frame_buffer = None
+        self.frame_publisher = None
+        if frames_port is not None:
+            self.frame_publisher = FramePublisher(frames_port, ring=frame_ring)
+        self.concurrent = concurrent
+        self.abort_requested = threading.Event()
+        self._state = 'idle'
+        self._progress = None
+        if concurrent:
+            self._init_concurrent(port)
+        else:
+            ZMQServer.__init__(self, port, dtype='string')
+
+    def _init_concurrent(self, port):
+        # Like ZMQServer.__init__(), but with a ROUTER socket, so that we may defer
+        # responding to one client whilst responding to others. Secured with the shared
+        # secret from labconfig in the same way:
+        self.port = port
+        self.dtype = 'string'
+        self.pull_only = False
+        self.stopping = False
+        self._crashed = threading.Event()
+        config = get_config()
+        self.shared_secret = config['shared_secret']
+        self.allow_insecure = config['allow_insecure']
+        self.context = SecureContext.instance(shared_secret=self.shared_secret)
+        self.sock = self.context.socket(zmq.ROUTER, allow_insecure=self.allow_insecure)
+        self.sock.setsockopt(zmq.LINGER, 0)
+        self.sock.bind('tcp://*:%d' % self.port)
+        self._shutdown_sock = self.context.socket(zmq.PULL)
+        self._shutdown_endpoint = 'inproc://zpself' + hexlify(os.urandom(8)).decode()
+        self._shutdown_sock.bind(self._shutdown_endpoint)
+        # Responses from the worker thread are passed to the mainloop via this socket:
+        self._responses_sock = self.context.socket(zmq.PULL)
+        self._responses_endpoint = 'inproc://camera' + hexlify(os.urandom(8)).decode()
+        self._responses_sock.bind(self._responses_endpoint)
+        self.poller = zmq.Poller()
+        for sock in [self.sock, self._shutdown_sock, self._responses_sock]:
+            self.poller.register(sock, zmq.POLLIN)
+        # Clients between sending a filepath or 'done' and the empty string that
+        # follows it, and the transition they requested:
+        self._handshakes = {}
+        self._jobs = queue.Queue()
+        self.worker_thread = threading.Thread(target=self._worker, daemon=True)
+        self.worker_thread.start()
+        self.mainloop_thread = threading.Thread(target=self.mainloop, daemon=True)
+        self.mainloop_thread.start()
+
+    def mainloop(self):
+        if not self.concurrent:
+            return ZMQServer.mainloop(self)
+        try:
+            while True:
+                events = dict(self.poller.poll())
+                if self._shutdown_sock in events:
+                    assert self._shutdown_sock.recv() == b'stop'
+                    break
+                if self._responses_sock in events:
+                    self.sock.send_multipart(self._responses_sock.recv_multipart())
+                if self.sock in events:
+                    # The envelope is the client identity followed by the empty
+                    # delimiter frame added by its REQ socket:
+                    *envelope, request_data = self.sock.recv_multipart()
+                    try:
+                        response = self._concurrent_handler(
+                            envelope, request_data.decode('utf8')
+                        )
+                    except Exception:
+                        response = self._format_exception()
+                    if response is not None:
+                        self.sock.send_multipart(envelope + [response.encode('utf8')])
+        except Exception:
+            self._crashed.set()
+            raise
+
+    def _concurrent_handler(self, envelope, request_data):
+        # Respond immediately to most requests, and queue transitions and aborts for
+        # the worker thread, returning None, in which case the worker responds:
+        if request_data == 'hello':
+            return 'hello'
+        elif request_data == 'status':
+            return self.status()
+        handshake = self._handshakes.pop(tuple(envelope), None)
+        if handshake is not None and request_data == '':
+            self._jobs.put((handshake, envelope))
+            return None
+        elif request_data.endswith('.h5'):
+            h5_filepath = labscript_utils.shared_drive.path_to_local(request_data)
+            self._handshakes[tuple(envelope)] = ('transition_to_buffered', h5_filepath)
+            return 'ok'
+        elif request_data == 'done':
+            self._handshakes[tuple(envelope)] = ('transition_to_static', None)
+            return 'ok'
+        elif request_data == 'abort':
+            self.abort_requested.set()
+            self._jobs.put((('abort', None), envelope))
+            return None
+        else:
+            raise ValueError('invalid request: %s' % request_data)
+
+    def _worker(self):
+        responses_sock = self.context.socket(zmq.PUSH)
+        responses_sock.connect(self._responses_endpoint)
         try:
-            print(request_data)
-            if request_data == 'hello':
-                return 'hello'
-            elif request_data.endswith('.h5'):
-                self._h5_filepath = labscript_utils.shared_drive.path_to_local(request_data)
-                self.send('ok')
-                self.recv()
+            while True:
+                job = self._jobs.get()
+                if job is None:
+                    break
+                (transition, h5_filepath), envelope = job
+                try:
+                    if transition == 'transition_to_buffered':
+                        self._h5_filepath = h5_filepath
+                    self._run(transition)
+                    response = 'done'
+                except Exception:
+                    response = self._format_exception()
+                responses_sock.send_multipart(envelope + [response.encode('utf8')])
+        finally:
+            responses_sock.close(linger=0)
+
+    def _format_exception(self):
+        # Raise the exception in a separate thread so that the server keeps running,
+        # and return it formatted in the same way as zprocess.ZMQServer would for the
+        # client:
+        raise_exception_in_thread(sys.exc_info())
+        msg = "The server had an unhandled exception whilst processing the request:\n"
+        return msg + traceback.format_exc()
+
+    def shutdown(self):
+        ZMQServer.shutdown(self)
+        if self.frame_publisher is not None:
+            self.frame_publisher.close()
+        if self.concurrent:
+            self._jobs.put(None)
+            self.worker_thread.join()
+            self._shutdown_sock.close(linger=0)
+            self._responses_sock.close(linger=0)
+
+    def status(self):
+        """Return a string describing what the camera server is doing, and its
+        progress as last reported with report_progress()"""
+        state, progress = self._state, self._progress
+        if progress is None:
+            return state
+        return '%s: %s' % (state, progress)
+
+    def report_progress(self, progress):
+        """Set a string describing progress of the current transition, for example
+        '12/40 images saved', to be included in responses to status requests."""
+        self._progress = progress
+
+    def _run(self, transition):
+        # Call the method for the given transition, keeping track of state and
+        # calling abort() if it raises an exception:
+        self._state = transition
+        self._progress = None
+        try:
+            if transition == 'transition_to_buffered':
                 self.transition_to_buffered(self._h5_filepath)
-                return 'done'
-            elif request_data == 'done':
-                self.send('ok')
-                self.recv()
+                self._state = 'buffered'
+            elif transition == 'transition_to_static':
                 self.transition_to_static(self._h5_filepath)
+                self._save_frames(self._h5_filepath)
                 self._h5_filepath = None
-                return 'done'
-            elif request_data == 'abort':
-                self.abort()
+                self._state = 'idle'
+            elif transition == 'abort':
+                self.abort_requested.clear()
+                try:
+                    self.abort()
+                finally:
+                    self._discard_frames()
                 self._h5_filepath = None
-                return 'done'
-            else:
-                raise ValueError('invalid request: %s'%request_data)
+                self._state = 'idle'
         except Exception:
-            if self._h5_filepath is not None and request_data != 'abort':
+            if self._h5_filepath is not None and transition != 'abort':
                 try:
                     self.abort()
                 except Exception as e:
-                    sys.stderr.write('Exception in self.abort() while handling another exception:\n{}\n'.format(str(e)))
+                    msg = 'Exception in self.abort() while handling another exception:'
+                    sys.stderr.write('{}\n{}\n'.format(msg, e))
+                self._discard_frames()
             self._h5_filepath = None
+            self._state = 'idle'
             raise
+        finally:
+            self._progress = None
+
+    def add_frame(self, name, frame):
+        """Buffer a frame during a shot, to be saved to the shot file at the end of the
+        shot, after transition_to_static() returns, as part of a stack of all frames
+        added with the same name. name is the path of the dataset relative to the group
+        self.frames_group. See FrameBuffer for details."""
+        if self.frame_buffer is None:
+            self.frame_buffer = FrameBuffer(**self.frame_buffer_options)
+        self.frame_buffer.add_frame(name, frame)
+
+    def add_image(self, name, image):
+        """Like add_frame(), but save the image as its own dataset rather than
+        appending it to a stack"""
+        if self.frame_buffer is None:
+            self.frame_buffer = FrameBuffer(**self.frame_buffer_options)
+        self.frame_buffer.add_image(name, image)
+
+    def publish_frame(self, name, frame, **metadata):
+        """Send a frame to clients connected to the server's frames_port, if it was
+        given one, such as for live viewing. The frame is sent without being copied,
+        so must not be modified afterward. Frames are dropped if clients cannot keep
+        up. See FramePublisher for details."""
+        if self.frame_publisher is not None:
+            self.frame_publisher.publish(name, frame, **metadata)
+
+    def _save_frames(self, h5_filepath):
+        if self.frame_buffer is None or not self.frame_buffer.n_queued:
+            return
+        self.report_progress('saving images')
+        stats = self.frame_buffer.save(h5_filepath, self.frames_group)
+        megabytes = stats['n_bytes'] / 1e6
+        print(
+            'saved %d images (%.1f MB) in %.3f s, shot file open for %.3f s (%.1f MB/s)'
+            % (
+                stats['n_images'],
+                megabytes,
+                stats['write_time'] + stats['copy_time'],
+                stats['copy_time'],
+                megabytes / max(stats['copy_time'], 1e-9),
+            )
+        )
+
+    def _discard_frames(self):
+        if self.frame_buffer is not None:
+            self.frame_buffer.discard()
+
+    def handler(self, request_data):
+        # _run() calls abort() if a transition fails, so there is nothing to clean up
+        # here:
+        if request_data == 'hello':
+            return 'hello'
+        elif request_data == 'status':
+            return self.status()
+        elif request_data.endswith('.h5'):
+            h5_filepath = labscript_utils.shared_drive.path_to_local(request_data)
+            self.send('ok')
+            self.recv()
+            self._h5_filepath = h5_filepath
+            self._run('transition_to_buffered')
+            return 'done'
+        elif request_data == 'done':
+            self.send('ok')
+            self.recv()
+            self._run('transition_to_static')
+            return 'done'
+        elif request_data == 'abort':
+            self._run('abort')
+            return 'done'
+        else:
+            raise ValueError('invalid request: %s'%request_data)
 
     def transition_to_buffered(self, h5_filepath):
         """To be overridden by subclasses. Do any preparatory processing
@@ -187,8 +974,228 @@ class TubingenCameraServer(CameraServer):
         # transition_to_static, except without saving any data to a h5 file.
         pass
 
+class SimulatedCameraServer(CameraServer):
+    """Camera server with a simulated camera, which during each shot generates
+    n_frames random frames of the given frame_shape and frame_dtype at frame_rate
+    frames per second, buffering them with add_frame() and publishing them with
+    publish_frame(). Used by benchmark()."""
+
+    def __init__(
+        self,
+        port,
+        n_frames=10,
+        frame_shape=(1024, 1024),
+        frame_dtype='uint16',
+        frame_rate=100.0,
+        **kwargs
+    ):
+        self.n_frames = n_frames
+        self.frame_shape = tuple(frame_shape)
+        # Not self.dtype, which is the ZMQServer's wire format:
+        self.frame_dtype = np.dtype(frame_dtype)
+        self.frame_rate = frame_rate
+        self._acquisition = None
+        self._stop_acquisition = threading.Event()
+        # Generate frames in advance, so that we measure the server rather than the
+        # random number generator:
+        rng = np.random.default_rng()
+        self._frames = [
+            rng.integers(0, 1000, self.frame_shape).astype(self.frame_dtype)
+            for _ in range(min(n_frames, 8))
+        ]
+        CameraServer.__init__(self, port, **kwargs)
+
+    def _acquire(self):
+        start_time = time.perf_counter()
+        for i in range(self.n_frames):
+            deadline = start_time + i / self.frame_rate
+            if self._stop_acquisition.wait(max(0, deadline - time.perf_counter())):
+                return
+            frame = self._frames[i % len(self._frames)]
+            self.add_frame('simulated_camera/frames', frame)
+            self.publish_frame('simulated_camera', frame)
+
+    def transition_to_buffered(self, h5_filepath):
+        self._stop_acquisition.clear()
+        self._acquisition = threading.Thread(target=self._acquire, daemon=True)
+        self._acquisition.start()
+
+    def transition_to_static(self, h5_filepath):
+        self._acquisition.join()
+        self._acquisition = None
+
+    def abort(self):
+        if self._acquisition is not None:
+            self._stop_acquisition.set()
+            self._acquisition.join()
+            self._acquisition = None
+
+
+def benchmark(port, n_shots=20, shot_duration=0, timeout=60):
+    """Drive the camera server on the given port on localhost through n_shots shots
+    of the protocol that BLACS uses, waiting shot_duration seconds between
+    transition_to_buffered and transition_to_static, with each shot followed by an
+    abort. Shot files are created in a temporary directory. Returns a dict of lists
+    of the latencies in seconds of each phase: 'hello', 'transition_to_buffered',
+    'transition_to_static' and 'abort', and a list 'bytes' of the number of bytes
+    written to each shot file."""
+    # Secured in the same way as the server, with the shared secret from labconfig:
+    config = get_config()
+    context = SecureContext.instance(shared_secret=config['shared_secret'])
+    sock = context.socket(zmq.REQ, allow_insecure=config['allow_insecure'])
+    sock.setsockopt(zmq.LINGER, 0)
+    sock.connect('tcp://127.0.0.1:%d' % port)
+
+    def request(message):
+        sock.send_string(message)
+        if not sock.poll(int(timeout * 1000)):
+            raise TimeoutError('No response from camera server to %r' % message)
+        return sock.recv_string()
+
+    def transition(message):
+        start_time = time.perf_counter()
+        response = request(message)
+        if response != 'ok':
+            raise RuntimeError(response)
+        response = request('')
+        if response != 'done':
+            raise RuntimeError(response)
+        return time.perf_counter() - start_time
+
+    results = {
+        'hello': [],
+        'transition_to_buffered': [],
+        'transition_to_static': [],
+        'abort': [],
+        'bytes': [],
+    }
+    try:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for shot in range(n_shots):
+                h5_filepath = os.path.join(temp_dir, 'shot_%04d.h5' % shot)
+                with h5py.File(h5_filepath, 'w'):
+                    pass
+                start_time = time.perf_counter()
+                if request('hello') != 'hello':
+                    raise RuntimeError('Invalid response to hello')
+                results['hello'].append(time.perf_counter() - start_time)
+                path = labscript_utils.shared_drive.path_to_agnostic(h5_filepath)
+                results['transition_to_buffered'].append(transition(path))
+                time.sleep(shot_duration)
+                results['transition_to_static'].append(transition('done'))
+                start_time = time.perf_counter()
+                response = request('abort')
+                if response != 'done':
+                    raise RuntimeError(response)
+                results['abort'].append(time.perf_counter() - start_time)
+                results['bytes'].append(os.path.getsize(h5_filepath))
+                os.unlink(h5_filepath)
+    finally:
+        sock.close()
+    return results
+
+
+def print_benchmark_results(results):
+    print('%-24s %9s %9s %9s %9s' % ('phase (ms)', 'median', '90%', '99%', 'max'))
+    for phase in ['hello', 'transition_to_buffered', 'transition_to_static', 'abort']:
+        latencies = 1000 * np.array(results[phase])
+        print(
+            '%-24s %9.2f %9.2f %9.2f %9.2f'
+            % (
+                phase,
+                np.percentile(latencies, 50),
+                np.percentile(latencies, 90),
+                np.percentile(latencies, 99),
+                latencies.max(),
+            )
+        )
+    megabytes = sum(results['bytes']) / 1e6
+    static_time = sum(results['transition_to_static'])
+    print(
+        'wrote %.1f MB to %d shot files, %.1f MB/s during transition_to_static'
+        % (megabytes, len(results['bytes']), megabytes / static_time)
+    )
+
+
+def _bench_main():
+    import argparse
+    from labscript_utils import import_or_reload
+
+    parser = argparse.ArgumentParser(
+        prog='python -m labscript_utils.camera_server --bench',
+        description="""Benchmark a camera server by driving it through shots using the
+            same protocol as BLACS. By default a SimulatedCameraServer is run in this
+            process.""",
+    )
+    parser.add_argument('--bench', action='store_true')
+    parser.add_argument('--shots', type=int, default=20, help='number of shots')
+    parser.add_argument('--frames', type=int, default=10, help='frames per shot')
+    parser.add_argument(
+        '--shape', type=int, nargs=2, default=(1024, 1024), help='frame shape'
+    )
+    parser.add_argument('--dtype', default='uint16', help='frame dtype')
+    parser.add_argument('--rate', type=float, default=100.0, help='frames per second')
+    parser.add_argument('--compression', default=None, help="e.g. 'gzip' or 'lzf'")
+    parser.add_argument('--concurrent', action='store_true', help='concurrent mode')
+    parser.add_argument(
+        '--server',
+        default=None,
+        help="""A CameraServer subclass to benchmark instead of the simulated camera,
+            as module.ClassName. It will be instantiated with a port as its only
+            argument""",
+    )
+    parser.add_argument(
+        '--port', type=int, default=None, help='Port, by default a random free port'
+    )
+    args = parser.parse_args()
+
+    port = args.port
+    if port is None:
+        # Find a free port:
+        sock = zmq.Context.instance().socket(zmq.REP)
+        port = sock.bind_to_random_port('tcp://127.0.0.1')
+        sock.close(linger=0)
+
+    if args.server is not None:
+        module_name, class_name = args.server.rsplit('.', 1)
+        server_class = getattr(import_or_reload(module_name), class_name)
+        server = server_class(port)
+    else:
+        server = SimulatedCameraServer(
+            port,
+            n_frames=args.frames,
+            frame_shape=args.shape,
+            frame_dtype=args.dtype,
+            frame_rate=args.rate,
+            concurrent=args.concurrent,
+        )
+        server.frame_buffer_options = {'compression': args.compression}
+        frame_bytes = np.dtype(args.dtype).itemsize * np.prod(args.shape)
+        print(
+            'simulated camera: %d frames of %s %s (%.1f MB) per shot at %g fps'
+            % (
+                args.frames,
+                'x'.join(str(n) for n in args.shape),
+                args.dtype,
+                args.frames * frame_bytes / 1e6,
+                args.rate,
+            )
+        )
+    try:
+        results = benchmark(
+            port, n_shots=args.shots, shot_duration=args.frames / args.rate
+        )
+    finally:
+        server.shutdown()
+    print_benchmark_results(results)
+
+
 if __name__ == '__main__':
 
+    if '--bench' in sys.argv:
+        _bench_main()
+        sys.exit(0)
+
     # How to run a camera server:
 
     port = 8765
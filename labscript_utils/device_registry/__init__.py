@@ -1,5 +1,17 @@
 from ._device_registry import *
 
+# LABSCRIPT_DEVICES_DIRS is exported, but only computed when first accessed, by
+# __getattr__ below. Merely importing this package therefore does not compute it, but
+# 'from labscript_utils.device_registry import *' does:
+__all__ = _device_registry.__all__ + ['LABSCRIPT_DEVICES_DIRS']
+
+
+def __getattr__(name):
+    if name == 'LABSCRIPT_DEVICES_DIRS':
+        return _device_registry.LABSCRIPT_DEVICES_DIRS
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
 # Backwards compatibility for labscript-devices < 3.1. If labscript_devices defines the
 # device registry as well, undo the above import and use the contents of
 # labscript_devices instead. The above import must be done first so that the names are
@@ -1,11 +1,17 @@
 import importlib.machinery
 import os
+import sys
+import ast
+import json
 import importlib
 import warnings
 import traceback
 import inspect
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from labscript_utils import dedent
-from labscript_utils.labconfig import LabConfig
+from labscript_utils.labconfig import LabConfig, _write_file_atomic
+from labscript_profile import LABSCRIPT_SUITE_PROFILE
 
 
 """This file contains the machinery for registering and looking up what BLACS tab and
@@ -45,8 +51,9 @@ The old method may be deprecated in the future.
 """
 
 
+# LABSCRIPT_DEVICES_DIRS is not in __all__, since it is computed on first access, and
+# 'import *' would access it. The device_registry package exports it instead, lazily.
 __all__ = [
-    'LABSCRIPT_DEVICES_DIRS',
     'labscript_device',
     'BLACS_worker',
     'BLACS_tab',
@@ -55,6 +62,8 @@ __all__ = [
     'deprecated_import_alias',
     'get_BLACS_tab',
     'get_runviewer_parser',
+    'clear_class_cache',
+    'prefetch_classes',
     'register_classes',
 ]
 
@@ -74,7 +83,7 @@ def _get_device_dirs():
     """Return the directory of labscript_devices, and the folders containing
     submodules of any packages listed in the user_devices labconfig setting"""
     try:
-        user_devices = LabConfig().get('DEFAULT', 'user_devices')
+        user_devices = LabConfig.instance().get('DEFAULT', 'user_devices')
     except (LabConfig.NoOptionError, LabConfig.NoSectionError):
         user_devices = 'user_devices'
     # Split on commas, remove whitespace:
@@ -82,7 +91,29 @@ def _get_device_dirs():
     return _get_import_paths(['labscript_devices'] + user_devices)
 
 
-LABSCRIPT_DEVICES_DIRS = _get_device_dirs()
+# LABSCRIPT_DEVICES_DIRS is computed on first access, since doing so requires reading
+# labconfig and searching for packages, which processes that never look up a device
+# class need not do:
+_device_dirs_lock = threading.Lock()
+
+
+def _labscript_devices_dirs():
+    """Return LABSCRIPT_DEVICES_DIRS, computing it if it has not yet been computed (or
+    otherwise set)"""
+    try:
+        return globals()['LABSCRIPT_DEVICES_DIRS']
+    except KeyError:
+        pass
+    with _device_dirs_lock:
+        if 'LABSCRIPT_DEVICES_DIRS' not in globals():
+            globals()['LABSCRIPT_DEVICES_DIRS'] = _get_device_dirs()
+    return globals()['LABSCRIPT_DEVICES_DIRS']
+
+
+def __getattr__(name):
+    if name == 'LABSCRIPT_DEVICES_DIRS':
+        return _labscript_devices_dirs()
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
 
 class ClassRegister(object):
@@ -204,24 +235,94 @@ BLACS_tab_registry = {}
 runviewer_parser_registry = {}
 # The script files that registered each device, for use in error messages:
 _register_classes_script_files = {}
-
-# Wrapper functions to get devices out of the class registries.
+# List to which calls to register_classes() are appended whilst running a script, so
+# that they can be saved in the registry index:
+_recorded_registrations = None
+
+# Classes already looked up by get_BLACS_tab() and get_runviewer_parser(), keyed by
+# (registry name, device name). Failed lookups are cached as (exception, traceback):
+_resolved_classes = {}
+# Held whilst populating the registry. Lookups wait for population to complete, since
+# until then the registry may be missing devices it will go on to contain:
+_populate_lock = threading.RLock()
+# Set once populate_registry() has returned:
+_registry_populated = False
+
+
+def _resolve_class(name, registry, class_register):
+    key = (class_register.instancename, name)
+    try:
+        result = _resolved_classes[key]
+    except KeyError:
+        try:
+            if not _registry_populated:
+                with _populate_lock:
+                    if not _registry_populated:
+                        populate_registry()
+            if name in registry:
+                result = import_class_by_fullname(registry[name])
+            else:
+                # Fall back on file naming convention + decorator method:
+                result = class_register[name]
+        except Exception as e:
+            result = (e, e.__traceback__)
+        # Don't cache failures caused by the registry not being populated, such as if
+        # populate_registry() raised an exception:
+        if _registry_populated:
+            _resolved_classes[key] = result
+    if isinstance(result, tuple):
+        exception, tb = result
+        raise exception.with_traceback(tb)
+    return result
+
+
+# Wrapper functions to get devices out of the class registries. Results, including
+# failures, are cached. Call clear_class_cache() to look classes up afresh.
 def get_BLACS_tab(name):
-    if not BLACS_tab_registry:
-        populate_registry()
-    if name in BLACS_tab_registry:
-        return import_class_by_fullname(BLACS_tab_registry[name])
-    # Fall back on file naming convention + decorator method:
-    return BLACS_tab[name]
+    return _resolve_class(name, BLACS_tab_registry, BLACS_tab)
 
 
 def get_runviewer_parser(name):
-    if not runviewer_parser_registry:
-        populate_registry()
-    if name in runviewer_parser_registry:
-        return import_class_by_fullname(runviewer_parser_registry[name])
-    # Fall back on file naming convention + decorator method:
-    return runviewer_parser[name]
+    return _resolve_class(name, runviewer_parser_registry, runviewer_parser)
+
+
+def clear_class_cache():
+    """Forget the results of previous calls to get_BLACS_tab() and
+    get_runviewer_parser(), including failures"""
+    _resolved_classes.clear()
+
+
+def prefetch_classes(devices, BLACS_tabs=True, runviewer_parsers=False):
+    """Import, in background threads, the BLACS tab and/or runviewer parser classes for
+    the given devices, so that subsequent calls to get_BLACS_tab() and
+    get_runviewer_parser() for them return immediately. devices may be an iterable of
+    device class names, or the path to an HDF5 file containing a connection table, in
+    which case the classes of all devices in it are used. Returns a list of futures,
+    which may be ignored. Errors are not raised here but by subsequent lookups."""
+    if isinstance(devices, (str, os.PathLike)):
+        import labscript_utils.h5_lock
+        import h5py
+
+        with h5py.File(devices, 'r') as f:
+            classes = f['connection table']['class']
+        devices = [c.decode('utf8') if isinstance(c, bytes) else c for c in classes]
+    getters = []
+    if BLACS_tabs:
+        getters.append(get_BLACS_tab)
+    if runviewer_parsers:
+        getters.append(get_runviewer_parser)
+    names = list(dict.fromkeys(devices))
+
+    def prefetch(getter, name):
+        try:
+            getter(name)
+        except Exception:
+            pass
+
+    executor = ThreadPoolExecutor(_N_WORKERS, thread_name_prefix='prefetch_classes')
+    futures = [executor.submit(prefetch, g, name) for g in getters for name in names]
+    executor.shutdown(wait=False)
+    return futures
 
 
 def register_classes(labscript_device_name, BLACS_tab=None, runviewer_parser=None):
@@ -236,6 +337,13 @@ def register_classes(labscript_device_name, BLACS_tab=None, runviewer_parser=Non
     subfolder of labscript_devices. When BLACS or runviewer start up, they will call
     populate_registry(), which will find and run all such files to populate the class
     registries prior to looking up the classes they need"""
+    # The calling frame's file is the script doing the registering. This is much
+    # cheaper than inspect.stack(), which reads the source of every frame:
+    script_filename = os.path.abspath(sys._getframe(1).f_code.co_filename)
+    _register(labscript_device_name, BLACS_tab, runviewer_parser, script_filename)
+
+
+def _register(labscript_device_name, BLACS_tab, runviewer_parser, script_filename):
     if labscript_device_name in _register_classes_script_files:
         other_script =_register_classes_script_files[labscript_device_name]
         msg = """A device named %s has already been registered by the script %s.
@@ -243,25 +351,282 @@ def register_classes(labscript_device_name, BLACS_tab=None, runviewer_parser=Non
         raise ValueError(dedent(msg) % (labscript_device_name, other_script))
     BLACS_tab_registry[labscript_device_name] = BLACS_tab
     runviewer_parser_registry[labscript_device_name] = runviewer_parser
-    script_filename = os.path.abspath(inspect.stack()[1][0].f_code.co_filename)
     _register_classes_script_files[labscript_device_name] = script_filename
+    if _recorded_registrations is not None:
+        _recorded_registrations.append(
+            [labscript_device_name, BLACS_tab, runviewer_parser, script_filename]
+        )
+
 
+# An index of the register_classes.py scripts found in LABSCRIPT_DEVICES_DIRS and the
+# registrations each made, so that subsequent calls to populate_registry() need only
+# re-run scripts that have changed, and only list directories that have changed:
+REGISTRY_INDEX_PATH = os.path.join(
+    LABSCRIPT_SUITE_PROFILE, 'app_saved_configs', 'device_registry_index.json'
+)
+_REGISTRY_INDEX_VERSION = 1
 
-def populate_registry():
+
+def _new_registry_index():
+    # 'dirs' maps each directory to its mtime, the subdirectories to descend into, and
+    # whether it contains a register_classes.py. 'scripts' maps each script to its
+    # mtime and size, and the registrations it made:
+    return {'version': _REGISTRY_INDEX_VERSION, 'dirs': {}, 'scripts': {}}
+
+
+def _load_registry_index():
+    try:
+        with open(REGISTRY_INDEX_PATH, encoding='utf8') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return _new_registry_index()
+    if not isinstance(index, dict) or index.get('version') != _REGISTRY_INDEX_VERSION:
+        return _new_registry_index()
+    return index
+
+
+def _scan_dir(folder):
+    """Return the subdirectories of folder that os.walk() would descend into, and
+    whether it contains a file called register_classes.py"""
+    subdirs = []
+    has_script = False
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                if not entry.is_symlink():
+                    subdirs.append(entry.name)
+            elif entry.name == 'register_classes.py':
+                has_script = True
+    return subdirs, has_script
+
+
+def _visit_dir(folder, old_index):
+    """Return the index entry for a directory, listing it only if its mtime differs
+    from that in old_index. Returns None if it cannot be listed."""
+    try:
+        mtime_ns = os.stat(folder).st_mtime_ns
+        entry = old_index['dirs'].get(folder)
+        if entry is None or entry['mtime_ns'] != mtime_ns:
+            subdirs, has_script = _scan_dir(folder)
+            entry = {'mtime_ns': mtime_ns, 'subdirs': subdirs, 'script': has_script}
+    except OSError:
+        # Like os.walk(), ignore directories we can't list:
+        return None
+    return entry
+
+
+# Number of threads for listing directories and parsing scripts. Filesystem access
+# releases the GIL, so this can usefully exceed the number of CPUs on slow filesystems:
+_N_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+
+
+def _map_chunked(executor, func, items, *args):
+    """Like executor.map(func, items), but with each task processing a chunk of items,
+    to reduce the overhead of many small tasks. Returns a list."""
+    chunk_size = max(1, -(-len(items) // (4 * _N_WORKERS)))
+    chunks = [items[i : i + chunk_size] for i in range(0, len(items), chunk_size)]
+    results = executor.map(lambda chunk: [func(item, *args) for item in chunk], chunks)
+    return [result for chunk_results in results for result in chunk_results]
+
+
+def _find_register_classes_scripts(devices_dirs, old_index, new_index, executor):
+    """Return the paths of all files called register_classes.py within devices_dirs,
+    in the order os.walk() would find them. Directories whose mtime matches that in
+    old_index are not listed, their contents are taken from the index instead. Entries
+    for all directories visited are added to new_index. Directories are visited
+    concurrently, one level of depth at a time, using the given executor."""
+    entries = {}
+    level = list(devices_dirs)
+    while level:
+        results = _map_chunked(executor, _visit_dir, level, old_index)
+        next_level = []
+        for folder, entry in zip(level, results):
+            if entry is None or folder in entries:
+                continue
+            entries[folder] = entry
+            next_level.extend(os.path.join(folder, name) for name in entry['subdirs'])
+        level = next_level
+    # Now put the results in the order os.walk() would have found them:
+    scripts = []
+    for devices_dir in devices_dirs:
+        folders = [devices_dir]
+        while folders:
+            folder = folders.pop()
+            entry = entries.get(folder)
+            if entry is None:
+                continue
+            new_index['dirs'][folder] = entry
+            if entry['script']:
+                scripts.append(os.path.join(folder, 'register_classes.py'))
+            # Reversed, so that subdirectories are popped in order:
+            subdirs = reversed(entry['subdirs'])
+            folders.extend(os.path.join(folder, name) for name in subdirs)
+    return scripts
+
+
+def _stat_script(script):
+    try:
+        stat = os.stat(script)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+# Modules that register_classes.py scripts may import without us having to run them:
+_REGISTRY_MODULES = ('labscript_devices', 'labscript_utils')
+
+
+def _is_register_classes(func):
+    # Whether a call is to register_classes(), either imported by name or as an
+    # attribute of a module:
+    if isinstance(func, ast.Name):
+        return func.id == 'register_classes'
+    return isinstance(func, ast.Attribute) and func.attr == 'register_classes'
+
+
+def _parse_register_classes_script(script):
+    """Return the registrations a register_classes.py script would make, by parsing it
+    rather than running it. Returns None if the script does anything other than import
+    from labscript_devices or labscript_utils and call register_classes() with literal
+    arguments, in which case it must be run instead."""
+    script_filename = os.path.abspath(script)
+    try:
+        with open(script, 'rb') as f:
+            tree = ast.parse(f.read(), script)
+    except (OSError, SyntaxError, ValueError):
+        # Run it instead, so that any errors are raised as usual:
+        return None
+    registrations = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            names = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom):
+            names = [node.module or '']
+            if node.level:
+                return None
+        elif isinstance(node, ast.Expr) and isinstance(node.value, ast.Constant):
+            # A docstring or other constant:
+            continue
+        elif isinstance(node, ast.Expr) and isinstance(node.value, ast.Call):
+            call = node.value
+            if not _is_register_classes(call.func):
+                return None
+            try:
+                args = [ast.literal_eval(arg) for arg in call.args]
+                kwargs = {kw.arg: ast.literal_eval(kw.value) for kw in call.keywords}
+                arguments = inspect.signature(register_classes).bind(*args, **kwargs)
+            except (ValueError, TypeError, SyntaxError):
+                # Non-literal or invalid arguments, including *args or **kwargs:
+                return None
+            arguments.apply_defaults()
+            registrations.append(list(arguments.args) + [script_filename])
+            continue
+        else:
+            return None
+        if not all(name.split('.')[0] in _REGISTRY_MODULES for name in names):
+            return None
+    return registrations
+
+
+def _run_register_classes_script(script):
+    """Run a register_classes.py script and return the registrations it made"""
+    global _recorded_registrations
+    folder = os.path.dirname(script)
+    # Open the file using the import machinery, and run it. Fully importing the module
+    # would require adding it to sys.modules, and each would need a unique name, but we
+    # just need to run the registering code, not actually import the module:
+    spec = importlib.machinery.PathFinder.find_spec('register_classes', [folder])
+    mod = importlib.util.module_from_spec(spec)
+    _recorded_registrations = registrations = []
+    try:
+        spec.loader.exec_module(mod)
+    finally:
+        _recorded_registrations = None
+    return registrations
+
+
+def populate_registry(use_index=True):
     """Walk the labscript_devices folder looking for files called register_classes.py,
     and run them. These files are expected to make calls to
     register_classes() to inform us of what BLACS tabs and runviewer classes correspond
-    to their labscript device classes."""
-    # We execute the register_classes modules as a direct submodule of labscript_devices.
-    for devices_dir in LABSCRIPT_DEVICES_DIRS:
-        for folder, _, filenames in os.walk(devices_dir):
-            if 'register_classes.py' in filenames:
-                # The module name is the path to the file, relative to the labscript suite
-                # install directory:
-                # Open the file using the import machinery, and run it
-                spec = importlib.machinery.PathFinder.find_spec('register_classes', [folder])
-                mod = importlib.util.module_from_spec(spec)
-                spec.loader.exec_module(mod)
-                # fully importing module would require adding to sys.modules
-                # and each import would need to have unique names
-                # but we just need to run the registering code, not actually import the module
+    to their labscript device classes.
+
+    Scripts that only import from labscript_devices or labscript_utils and call
+    register_classes() with literal arguments are parsed rather than run, avoiding the
+    cost of running them and of any imports they make. Other scripts are run.
+
+    If use_index is True, the scripts found and the registrations each made are saved
+    to an index in the labscript profile. Subsequently, scripts and directories whose
+    modification times have not changed are not re-run or re-listed, and their
+    registrations are instead read from the index."""
+    global _registry_populated
+    with _populate_lock:
+        registries = [
+            BLACS_tab_registry,
+            runviewer_parser_registry,
+            _register_classes_script_files,
+        ]
+        saved = [dict(registry) for registry in registries]
+        try:
+            _populate_registry(use_index)
+        except:
+            # Roll back registrations made before the error, so that calling this
+            # again does not fail on devices being registered a second time:
+            for registry, contents in zip(registries, saved):
+                registry.clear()
+                registry.update(contents)
+            raise
+        _registry_populated = True
+
+
+def _populate_registry(use_index):
+    old_index = _load_registry_index() if use_index else _new_registry_index()
+    new_index = _new_registry_index()
+    with ThreadPoolExecutor(_N_WORKERS) as executor:
+        scripts = _find_register_classes_scripts(
+            _labscript_devices_dirs(), old_index, new_index, executor
+        )
+        stats = _map_chunked(executor, _stat_script, scripts)
+        # Parse all new or modified scripts concurrently:
+        changed = []
+        for script, stat in zip(scripts, stats):
+            entry = old_index['scripts'].get(script)
+            if stat is not None and (
+                entry is None or [entry['mtime_ns'], entry['size']] != list(stat)
+            ):
+                changed.append(script)
+        parsed = _map_chunked(executor, _parse_register_classes_script, changed)
+        parsed = dict(zip(changed, parsed))
+        # Then register classes, in order:
+        for script, stat in zip(scripts, stats):
+            if stat is None:
+                continue
+            if script in parsed:
+                registrations = parsed[script]
+                # Only run the script if it could not be parsed:
+                if registrations is None:
+                    registrations = _run_register_classes_script(script)
+                else:
+                    for registration in registrations:
+                        _register(*registration)
+                mtime_ns, size = stat
+                entry = {
+                    'mtime_ns': mtime_ns,
+                    'size': size,
+                    'registrations': registrations,
+                }
+            else:
+                entry = old_index['scripts'][script]
+                for registration in entry['registrations']:
+                    _register(*registration)
+            new_index['scripts'][script] = entry
+    if use_index and new_index != old_index:
+        try:
+            _write_file_atomic(REGISTRY_INDEX_PATH, json.dumps(new_index))
+        except OSError as e:
+            msg = 'Could not save device registry index %s: %s'
+            warnings.warn(msg % (REGISTRY_INDEX_PATH, e))
@@ -12,8 +12,16 @@
 #####################################################################
 import sys
 import os
+import threading
+from time import monotonic
 
-from labscript_utils.ls_zprocess import Lock, connect_to_zlock_server, kill_lock
+from labscript_utils.ls_zprocess import (
+    Lock,
+    connect_to_zlock_server,
+    connect_to_zlock_server_async,
+    kill_lock,
+    ZLOCK_DEFAULT_TIMEOUT,
+)
 from labscript_utils import dedent
 from labscript_utils.shared_drive import path_to_agnostic
 
@@ -36,6 +44,97 @@ if 'h5py' in sys.modules:
         
 import h5py
 
+# Whether files opened read-only by multiple threads of this process at the same time
+# share a single read lock from the zlock server, rather than each taking their own:
+SHARE_READ_LOCKS = True
+
+# Don't let new readers join a shared read lock that has been held for longer than this
+# many seconds, lest it outlive the lock timeout if readers keep overlapping:
+MAX_READ_LEASE_AGE = ZLOCK_DEFAULT_TIMEOUT / 2
+
+
+class _ReadLease(object):
+    """A read-only zlock on a file, shared by all readers of the file in this process
+    and released when the last of them closes the file"""
+
+    def __init__(self, key):
+        self.key = key
+        self.lock = None
+        self.refcount = 1
+        self.acquired_time = None
+        self.failed = False
+        self.closing = False
+        self.ready = threading.Event()
+        self.released = threading.Event()
+
+    def expired(self):
+        if self.acquired_time is None:
+            return False
+        return monotonic() - self.acquired_time > MAX_READ_LEASE_AGE
+
+
+_read_leases = {}
+_read_leases_lock = threading.Lock()
+
+
+def _acquire_read_lease(key):
+    """Return a _ReadLease on the given key, acquiring a read lock from the zlock server
+    if no other thread in this process holds one. Return None if the existing lease is
+    too old to join, in which case the caller should acquire its own lock."""
+    while True:
+        with _read_leases_lock:
+            lease = _read_leases.get(key)
+            if lease is None:
+                lease = _read_leases[key] = _ReadLease(key)
+                owner = True
+            elif lease.closing:
+                owner = None
+            elif lease.expired():
+                return None
+            else:
+                lease.refcount += 1
+                owner = False
+        if owner is None:
+            # Wait for the previous lease to be released, then try again:
+            lease.released.wait()
+            continue
+        if owner:
+            # Acquire outside _read_leases_lock, since this can block for a long time:
+            try:
+                lease.lock = Lock(key, read_only=True)
+                lease.lock.acquire()
+            except:
+                with _read_leases_lock:
+                    del _read_leases[key]
+                lease.failed = True
+                lease.ready.set()
+                raise
+            lease.acquired_time = monotonic()
+            lease.ready.set()
+            return lease
+        lease.ready.wait()
+        if lease.failed:
+            # The thread acquiring the lease failed to. Try ourselves:
+            continue
+        return lease
+
+
+def _release_read_lease(lease):
+    with _read_leases_lock:
+        lease.refcount -= 1
+        if lease.refcount:
+            return
+        # Keep the lease in the dict until released, so that new readers wait rather
+        # than acquiring a lock on the same key that we are in the process of releasing:
+        lease.closing = True
+    try:
+        lease.lock.release()
+    finally:
+        with _read_leases_lock:
+            del _read_leases[lease.key]
+        lease.released.set()
+
+
 _File = h5py.File
 class File(_File):
     def __init__(self, name, mode=None, driver=None, libver=None, **kwds):
@@ -47,24 +146,36 @@ class File(_File):
             self.kill_lock = kill_lock
             self.kill_lock.acquire()
             # Ask other zlock users not to open the file while we have it open:
-            self.zlock = Lock(path_to_agnostic(name), **kwargs)
-            self.zlock.acquire()
+            key = path_to_agnostic(name)
+            try:
+                if mode == 'r' and SHARE_READ_LOCKS:
+                    self._read_lease = _acquire_read_lease(key)
+                if getattr(self, '_read_lease', None) is None:
+                    self.zlock = Lock(key, **kwargs)
+                    self.zlock.acquire()
+            except:
+                self.__dict__.pop('zlock', None)
+                self.kill_lock.release()
+                raise
         try:
             _File.__init__(self, name, mode, driver, libver, **kwds)
         except:
-            if hasattr(self, 'zlock'):
-                self.zlock.release()
-            if hasattr(self, 'kill_lock'):
-                self.kill_lock.release()
+            self._release_locks()
             raise
 
-    def close(self):
-        _File.close(self)
+    def _release_locks(self):
+        lease = self.__dict__.pop('_read_lease', None)
+        if lease is not None:
+            _release_read_lease(lease)
         if hasattr(self, 'zlock'):
             self.zlock.release()
         if hasattr(self, 'kill_lock'):
             self.kill_lock.release()
 
+    def close(self):
+        _File.close(self)
+        self._release_locks()
+
     # Overriding __exit__ is crucial. Since h5py.File.__exit__() holds h5py's
     # library-wide lock "phil", it calls close() whilst holding that lock. Our close()
     # method does not need the lock (h5py.File.close() does, but it acquires it itself
@@ -92,6 +203,12 @@ def hack_locks_onto_h5py():
 if os.environ.get('READTHEDOCS'):
     # prevent starting a zlock server on RTD, which always fails
     pass
+elif os.environ.get('LABSCRIPT_LAZY_ZLOCK', '').lower() in ('1', 'true', 'yes'):
+    # Opt-in: connect to (and if necessary start) the zlock server in the background,
+    # so that importing this module does not block. Opening a File will wait for the
+    # connection if it is not yet complete.
+    connect_to_zlock_server_async()
+    hack_locks_onto_h5py()
 else:
     connect_to_zlock_server()
     hack_locks_onto_h5py()
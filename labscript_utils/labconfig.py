@@ -10,11 +10,21 @@
 # for the full license.                                             #
 #                                                                   #
 #####################################################################
+import sys
 import os
+import io
+import math
+import json
+import time
+import shutil
+import atexit
+import traceback
+import threading
 import configparser
 from ast import literal_eval
 from pprint import pformat
 from pathlib import Path
+from types import MappingProxyType
 import warnings
 
 from labscript_utils import dedent
@@ -32,10 +42,101 @@ class EnvInterpolation(configparser.BasicInterpolation):
         return os.path.expandvars(value)
 
 
+_NO_FALLBACK = object()
+
+
+class LabConfigSnapshot(object):
+    """An immutable snapshot of a LabConfig, with all values interpolated in advance.
+    Like a ConfigParser, it can be indexed by section name to get a read-only
+    dictionary of option names and values, and has get(), getint(), getfloat() and
+    getboolean() methods matching those of LabConfig, which are plain dictionary
+    lookups. It is not a Mapping, since its get() method takes a section and option
+    rather than a key and default. Obtain one with LabConfig.snapshot()."""
+
+    NoOptionError = configparser.NoOptionError
+    NoSectionError = configparser.NoSectionError
+
+    def __init__(self, sections, boolean_states, config_path=None, errors=None):
+        # Interpolation errors for values that could not be interpolated, keyed by
+        # (section, option). These are raised when the value is looked up, as they
+        # would be by LabConfig:
+        self._errors = {} if errors is None else dict(errors)
+        self._sections = MappingProxyType(
+            {name: MappingProxyType(dict(opts)) for name, opts in sections.items()}
+        )
+        self._boolean_states = boolean_states
+        self.config_path = config_path
+
+    def __getitem__(self, section):
+        return self._sections[section]
+
+    def __iter__(self):
+        return iter(self._sections)
+
+    def __len__(self):
+        return len(self._sections)
+
+    def __contains__(self, section):
+        return section in self._sections
+
+    def sections(self):
+        return [section for section in self._sections if section != 'DEFAULT']
+
+    def has_section(self, section):
+        return section != 'DEFAULT' and section in self._sections
+
+    def has_option(self, section, option):
+        return option.lower() in self._sections.get(section, ())
+
+    def get(self, section, option, *, fallback=_NO_FALLBACK):
+        option = option.lower()
+        if (section, option) in self._errors:
+            raise self._errors[section, option]
+        try:
+            options = self._sections[section]
+        except KeyError:
+            if fallback is not _NO_FALLBACK:
+                return fallback
+            raise configparser.NoSectionError(section)
+        try:
+            return options[option]
+        except KeyError:
+            if fallback is not _NO_FALLBACK:
+                return fallback
+            raise configparser.NoOptionError(option, section)
+
+    def _get_converted(self, converter, section, option, fallback):
+        try:
+            value = self.get(section, option)
+        except (configparser.NoSectionError, configparser.NoOptionError):
+            if fallback is not _NO_FALLBACK:
+                return fallback
+            raise
+        return converter(value)
+
+    def getint(self, section, option, *, fallback=_NO_FALLBACK):
+        return self._get_converted(int, section, option, fallback)
+
+    def getfloat(self, section, option, *, fallback=_NO_FALLBACK):
+        return self._get_converted(float, section, option, fallback)
+
+    def getboolean(self, section, option, *, fallback=_NO_FALLBACK):
+        return self._get_converted(self._to_boolean, section, option, fallback)
+
+    def _to_boolean(self, value):
+        if value.lower() not in self._boolean_states:
+            raise ValueError('Not a boolean: %s' % value)
+        return self._boolean_states[value.lower()]
+
+
 class LabConfig(configparser.ConfigParser):
     NoOptionError = configparser.NoOptionError
     NoSectionError = configparser.NoSectionError
 
+    # Shared instances returned by LabConfig.instance(), keyed by config path:
+    _instances = {}
+    _instances_lock = threading.Lock()
+
     def __init__(
         self, config_path=default_config_path, required_params=None, defaults=None,
     ):
@@ -50,11 +151,7 @@ class LabConfig(configparser.ConfigParser):
         else:
             self.config_path = config_path
 
-        self.file_format = ""
-        for section, options in required_params.items():
-            self.file_format += "[%s]\n" % section
-            for option in options:
-                self.file_format += "%s = <value>\n" % option
+        self.file_format = self._format_required_params(required_params)
 
         # Load the config file
         configparser.ConfigParser.__init__(
@@ -79,54 +176,337 @@ class LabConfig(configparser.ConfigParser):
             else:
                 self.set("DEFAULT", "apparatus_name", experiment_name)
 
+        self._check_required_params(required_params)
+
+    @staticmethod
+    def _format_required_params(required_params):
+        file_format = ""
+        for section, options in required_params.items():
+            file_format += "[%s]\n" % section
+            for option in options:
+                file_format += "%s = <value>\n" % option
+        return file_format
+
+    def _check_required_params(self, required_params):
         try:
             for section, options in required_params.items():
                 for option in options:
                     self.get(section, option)
         except configparser.NoOptionError:
-            msg = f"""The experiment configuration file located at {config_path} does
-                not have the required keys. Make sure the config file contains the
-                following structure:\n{self.file_format}"""
+            msg = f"""The experiment configuration file located at {self.config_path}
+                does not have the required keys. Make sure the config file contains the
+                following structure:\n{self._format_required_params(required_params)}"""
             raise Exception(dedent(msg))
 
-
-def save_appconfig(filename, data):
-    """Save a dictionary as an ini file. The keys of the dictionary comprise the section
-    names, and the values must themselves be dictionaries for the names and values
-    within each section. All section values will be converted to strings with
-    pprint.pformat()."""
-    # Error checking
-    for section_name, section in data.items():
-        for name, value in section.items():
+    @staticmethod
+    def _file_signature(config_path):
+        """Return the (mtime, size) of each file in the config path, or None for files
+        that do not exist, for detecting changes to the config files"""
+        if not isinstance(config_path, list):
+            config_path = [config_path]
+        signature = []
+        for path in config_path:
             try:
-                valid = value == literal_eval(pformat(value))
-            except (ValueError, SyntaxError):
-                valid = False
-            if not valid:
-                msg = f"{section_name}/{name} value {value} not a Python built-in type"
-                raise TypeError(msg)
+                stat = os.stat(path)
+            except (OSError, TypeError):
+                signature.append(None)
+            else:
+                signature.append((stat.st_mtime_ns, stat.st_size))
+        return tuple(signature)
+
+    @classmethod
+    def instance(cls, config_path=default_config_path, required_params=None):
+        """Return a LabConfig for the given config path that is shared within this
+        process. The config file is only parsed the first time this is called, and
+        again if the file's modified time or size has changed since. The returned
+        instance is shared with other callers and must not be modified. To get an
+        independent instance that may be modified, instantiate LabConfig directly."""
+        if isinstance(config_path, list):
+            key = tuple(str(path) for path in config_path)
+        else:
+            key = str(config_path)
+        signature = cls._file_signature(config_path)
+        with cls._instances_lock:
+            cached = cls._instances.get(key)
+            if cached is not None and cached[0] == signature:
+                config = cached[1]
+            else:
+                config = cls(config_path)
+                cls._instances[key] = (signature, config)
+        if required_params is not None:
+            config._check_required_params(required_params)
+        return config
+
+    def snapshot(self):
+        """Return an immutable LabConfigSnapshot of the current contents of this
+        LabConfig, with all values interpolated and environment variables expanded in
+        a single pass. Lookups in the snapshot are plain dictionary lookups, making it
+        suitable for code that looks up config values repeatedly."""
+        sections = {}
+        errors = {}
+        for section in [self.default_section] + self.sections():
+            if section == self.default_section:
+                option_names = list(self.defaults())
+            else:
+                option_names = self.options(section)
+            options = {}
+            for option in option_names:
+                try:
+                    options[option] = self.get(section, option)
+                except configparser.InterpolationError as e:
+                    errors[section, option] = e
+            sections[section] = options
+        return LabConfigSnapshot(
+            sections, self.BOOLEAN_STATES, self.config_path, errors=errors
+        )
+
+
+def _literal_kind(value, _active=None):
+    """Classify a value to be saved in an appconfig file by walking its type. Returns
+    'json' if the value consists only of types that round-trip losslessly through
+    JSON, 'python' if it consists only of builtin types that can be read back with
+    ast.literal_eval(), or None if neither could be established, in which case the
+    value must be checked by formatting and parsing it."""
+    value_type = type(value)
+    if value_type in (str, int, bool) or value is None:
+        return 'json'
+    if value_type is float:
+        return 'json' if math.isfinite(value) else None
+    if value_type is complex:
+        if math.isfinite(value.real) and math.isfinite(value.imag):
+            return 'python'
+        return None
+    if value_type is bytes:
+        return 'python'
+    if value_type not in (list, tuple, set, dict):
+        return None
+    if value_type is set and not value:
+        # 'set()' cannot be parsed by literal_eval() on all supported Python versions
+        return None
+    # Guard against recursive containers:
+    if _active is None:
+        _active = set()
+    if id(value) in _active:
+        return None
+    _active.add(id(value))
+    try:
+        kind = 'json' if value_type in (list, dict) else 'python'
+        if value_type is dict:
+            for key, item in value.items():
+                key_kind = _literal_kind(key, _active)
+                item_kind = _literal_kind(item, _active)
+                if key_kind is None or item_kind is None:
+                    return None
+                if type(key) is not str or item_kind == 'python':
+                    kind = 'python'
+        else:
+            for item in value:
+                item_kind = _literal_kind(item, _active)
+                if item_kind is None:
+                    return None
+                if item_kind == 'python':
+                    kind = 'python'
+        return kind
+    finally:
+        _active.discard(id(value))
+
+
+def _format_appconfig_value(section_name, name, value):
+    kind = _literal_kind(value)
+    if kind == 'json':
+        return json.dumps(value, ensure_ascii=False)
+    elif kind == 'python':
+        return repr(value)
+    # Unknown types (such as subclasses of builtins): check they survive a round trip
+    # through the Python literal format:
+    formatted = pformat(value)
+    try:
+        valid = value == literal_eval(formatted)
+    except (ValueError, SyntaxError):
+        valid = False
+    if not valid:
+        msg = f"{section_name}/{name} value {value} not a Python built-in type"
+        raise TypeError(msg)
+    return formatted
+
+
+def _parse_appconfig_value(value):
+    # Values are JSON where possible, which is much faster to parse. Other values, and
+    # all values in files saved by older versions, are Python literals. JSON that is
+    # also a valid Python literal has the same meaning in both, so we can try JSON first
+    try:
+        return json.loads(value)
+    except ValueError:
+        return literal_eval(value)
+
+
+def _format_appconfig(data):
+    """Format a dictionary of appconfig data as the contents of an ini file"""
+    # Format all values first, so that nothing is written if any are invalid:
     data = {
-        section_name: {name: pformat(value) for name, value in section.items()}
+        section_name: {
+            name: _format_appconfig_value(section_name, name, value)
+            for name, value in section.items()
+        }
         for section_name, section in data.items()
     }
     c = configparser.ConfigParser(interpolation=None)
     c.optionxform = str  # preserve case
     c.read_dict(data)
-    Path(filename).parent.mkdir(parents=True, exist_ok=True)
-    with open(filename, 'w') as f:
-        c.write(f)
+    f = io.StringIO()
+    c.write(f)
+    return f.getvalue()
+
+
+def _write_file_atomic(filename, contents):
+    """Write contents to a temporary file and then move it into place, so that the file
+    is never left partially written if we crash partway through"""
+    filename = Path(filename)
+    filename.parent.mkdir(parents=True, exist_ok=True)
+    temp_filename = filename.with_name(
+        f'.{filename.name}.{os.getpid()}.{threading.get_ident()}.tmp'
+    )
+    try:
+        with open(temp_filename, 'w') as f:
+            f.write(contents)
+            f.flush()
+            os.fsync(f.fileno())
+        if filename.exists():
+            shutil.copymode(filename, temp_filename)
+        os.replace(temp_filename, filename)
+    except BaseException:
+        try:
+            os.unlink(temp_filename)
+        except OSError:
+            pass
+        raise
+
+
+class _AppConfigWriter(object):
+    """Writes appconfig files in a background thread for save_appconfig_async().
+    Multiple saves to the same file within the delay time are coalesced into a single
+    write of the most recent data."""
+
+    def __init__(self):
+        # Lock for the pending writes, held only briefly:
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        # Lock held whilst taking pending writes and writing them, so that an older
+        # write can never overtake a newer one to the same file:
+        self.write_lock = threading.Lock()
+        # Pending writes, {filename: (deadline, contents)}:
+        self.pending = {}
+        self.thread = None
+
+    def save(self, filename, contents, delay):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.mainloop, daemon=True)
+                self.thread.start()
+                atexit.register(self.flush)
+            if filename in self.pending:
+                # Keep the original deadline, so that a constant stream of saves does
+                # not postpone the write indefinitely:
+                deadline = self.pending[filename][0]
+            else:
+                deadline = time.monotonic() + delay
+            self.pending[filename] = (deadline, contents)
+            self.condition.notify()
+
+    def mainloop(self):
+        while True:
+            with self.lock:
+                while not self.pending:
+                    self.condition.wait()
+                timeout = min(d for d, _ in self.pending.values()) - time.monotonic()
+                if timeout > 0:
+                    self.condition.wait(timeout)
+                    continue
+            try:
+                self._write_pending(due_only=True)
+            except Exception:
+                sys.stderr.write('Exception writing appconfig file:\n')
+                traceback.print_exc()
+
+    def flush(self, filename=None):
+        """Write pending data for the given file now, or for all files if filename is
+        None."""
+        self._write_pending(filename=filename)
+
+    def _write_pending(self, filename=None, due_only=False):
+        with self.write_lock:
+            with self.lock:
+                now = time.monotonic()
+                writes = {}
+                for name, (deadline, contents) in list(self.pending.items()):
+                    if filename is not None and name != filename:
+                        continue
+                    if due_only and deadline > now:
+                        continue
+                    writes[name] = contents
+                    del self.pending[name]
+            # Attempt all writes, then raise the first exception, if any:
+            exception = None
+            for name, contents in writes.items():
+                try:
+                    _write_file_atomic(name, contents)
+                except Exception as e:
+                    if exception is None:
+                        exception = e
+            if exception is not None:
+                raise exception
+
+
+_appconfig_writer = _AppConfigWriter()
+
+
+def save_appconfig(filename, data):
+    """Save a dictionary as an ini file. The keys of the dictionary comprise the section
+    names, and the values must themselves be dictionaries for the names and values
+    within each section. Section values must be Python built-in types, and will be
+    saved as JSON if they can be represented as such without loss, otherwise as Python
+    literals. The file is replaced atomically."""
+    contents = _format_appconfig(data)
+    filename = os.path.abspath(filename)
+    # Discard any pending asynchronous save of older data to the same file:
+    with _appconfig_writer.write_lock:
+        with _appconfig_writer.lock:
+            _appconfig_writer.pending.pop(filename, None)
+        _write_file_atomic(filename, contents)
+
+
+def save_appconfig_async(filename, data, delay=0.5):
+    """Like save_appconfig(), but write the file in a background thread, coalescing
+    saves to the same file made within delay seconds of each other into a single write
+    of the most recent data. Values are validated immediately, so invalid data raises an
+    exception here as it would for save_appconfig(). Pending writes are flushed at
+    interpreter exit, or can be flushed sooner with flush_appconfig()."""
+    contents = _format_appconfig(data)
+    _appconfig_writer.save(os.path.abspath(filename), contents, delay)
+
+
+def flush_appconfig(filename=None):
+    """Write any pending data from save_appconfig_async() for the given file, or for
+    all files if filename is None, blocking until written."""
+    if filename is not None:
+        filename = os.path.abspath(filename)
+    _appconfig_writer.flush(filename)
 
 
 def load_appconfig(filename):
     """Load an .ini file and return a dictionary of its contents. All values will be
-    converted to Python objects with ast.literal_eval(). All keys will be lowercase
-    regardless of the written contents on the .ini file."""
+    converted to Python objects, from JSON or with ast.literal_eval(). All keys will be
+    lowercase regardless of the written contents on the .ini file. Any pending
+    asynchronous save to the file is written first."""
+    flush_appconfig(filename)
     c = configparser.ConfigParser(interpolation=None)
     c.optionxform = str  # preserve case
     # No file? No config - don't crash.
     if Path(filename).exists():
         c.read(filename)
     return {
-        section_name: {name: literal_eval(value) for name, value in section.items()}
+        section_name: {
+            name: _parse_appconfig_value(value) for name, value in section.items()
+        }
         for section_name, section in c.items()
     }
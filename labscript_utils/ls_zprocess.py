@@ -12,6 +12,12 @@
 #####################################################################
 import sys
 import os
+import json
+import atexit
+import socket
+import threading
+from collections import OrderedDict
+from time import monotonic, time, sleep
 from socket import gethostbyname
 from packaging.version import Version
 import zmq
@@ -19,8 +25,9 @@ import zmq
 import zprocess
 import zprocess.process_tree
 from zprocess.security import SecureContext, SecureSocket
-from labscript_utils.labconfig import LabConfig
+from labscript_utils.labconfig import LabConfig, _write_file_atomic
 from labscript_utils import dedent
+from labscript_profile import LABSCRIPT_SUITE_PROFILE
 import zprocess.zlog
 import zprocess.zlock
 import zprocess.remote
@@ -75,7 +82,7 @@ def get_config():
     if _cached_config is not None:
         return _cached_config
 
-    labconfig = LabConfig()
+    labconfig = LabConfig.instance()
     config = {}
     try:
         config['zlock_host'] = labconfig.get('servers', 'zlock')
@@ -127,6 +134,9 @@ class ProcessTree(zprocess.ProcessTree):
     singleton."""
 
     _instance = None
+    # Held whilst creating the singleton, since it may be created in a background thread
+    # by connect_to_zlock_server_async():
+    _instance_lock = threading.Lock()
 
     @classmethod
     def instance(cls):
@@ -139,7 +149,14 @@ class ProcessTree(zprocess.ProcessTree):
         # Otherwise, return previously initialised singleton for the top-level process:
         if cls._instance is not None:
             return cls._instance
-        # Otherwise, create that singleton and return it:
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._create_instance()
+        return cls._instance
+
+    @classmethod
+    def _create_instance(cls):
+        # Create the singleton for the top-level process:
         config = get_config()
         cls._instance = cls(
             shared_secret=config['shared_secret'],
@@ -156,8 +173,6 @@ class ProcessTree(zprocess.ProcessTree):
         # deprecated zlock calls can use it:
         zprocess.zlock._default_zlock_client = cls._instance.zlock_client
 
-        return cls._instance
-
 
 class ZMQServer(zprocess.ZMQServer):
     """A ZMQServer configured with security settings from labconfig"""
@@ -225,6 +240,241 @@ class ZMQClient(zprocess.ZMQClient):
         return cls._instance
         
 
+def _typecheck_or_convert_data(data, dtype):
+    """Check that data is of a type that can be sent with the given dtype, one of
+    'pyobj', 'multipart', 'string' or 'raw', and return it, with None converted to an
+    empty message and a single bytes object wrapped in a list for multipart messages.
+    Raises TypeError otherwise. Strings are not encoded: the data may not represent
+    text, so the receiving end could not know to decode it. This matches the checks
+    zprocess.ZMQClient makes before sending, which are not part of its public API."""
+    # When not using python objects, a null message should be empty:
+    if data is None and dtype in ['raw', 'multipart']:
+        data = b''
+    elif data is None and dtype == 'string':
+        data = ''
+    if dtype == 'multipart' and isinstance(data, bytes):
+        # Wrap up a single bytes object into a list so it doesn't get sent as one
+        # byte per message part:
+        data = [data]
+    if dtype == 'raw':
+        if not isinstance(data, bytes):
+            msg = 'raw sockets can only send bytes, not {}.'
+            raise TypeError(msg.format(type(data)))
+    elif dtype == 'string':
+        if not isinstance(data, str):
+            msg = 'string sockets can only send strings, not {}.'
+            raise TypeError(msg.format(type(data)))
+    elif dtype == 'multipart':
+        if not all(isinstance(part, bytes) for part in data):
+            msg = 'multipart sockets can only send an iterable of bytes objects, '
+            raise TypeError(msg + 'not {}.'.format(type(data)))
+    elif dtype != 'pyobj':
+        msg = "invalid dtype {}, must be 'raw', 'string', 'multipart' or 'pyobj'"
+        raise ValueError(msg.format(dtype))
+    return data
+
+
+class _PooledGetter(object):
+    """Callable for making requests of a given dtype with a PooledZMQClient, with the
+    same call signature as the get*() methods of zprocess.ZMQClient"""
+
+    def __init__(self, client, dtype):
+        self.client = client
+        self.dtype = dtype
+
+    def __call__(
+        self,
+        port,
+        host='localhost',
+        data=None,
+        timeout=5,
+        interruptor=None,
+        raise_server_exceptions=True,
+    ):
+        [response] = self.client.get_many(
+            [(port, host, data)],
+            timeout=timeout,
+            interruptor=interruptor,
+            raise_server_exceptions=raise_server_exceptions,
+            dtype=self.dtype,
+        )
+        return response
+
+
+class PooledZMQClient(ZMQClient):
+    """A ZMQClient configured with settings from labconfig that, instead of keeping a
+    single REQ socket per thread that is replaced whenever a different server is
+    contacted, keeps a pool of REQ sockets per server in each thread. This makes
+    alternating between servers cheap, allows requests from different threads to
+    proceed concurrently, and allows many requests to be sent before any responses are
+    awaited with get_many(). Push methods are as for ZMQClient. Call the .instance()
+    classmethod to get a singleton."""
+
+    _instance = None
+
+    # Maximum number of idle sockets to keep per server per thread:
+    max_idle_sockets = 8
+
+    def __init__(self):
+        ZMQClient.__init__(self)
+        self._local = threading.local()
+        self._hosts = {}
+        self.get = _PooledGetter(self, 'pyobj')
+        self.get_multipart = _PooledGetter(self, 'multipart')
+        self.get_string = _PooledGetter(self, 'string')
+        self.get_raw = _PooledGetter(self, 'raw')
+
+    def _gethostbyname(self, host):
+        # Cache name resolution, which otherwise can be slow compared to a request:
+        try:
+            return self._hosts[host]
+        except KeyError:
+            address = self._hosts[host] = gethostbyname(host)
+            return address
+
+    def _checkout(self, host, port, timeout, interruptor):
+        """Return an idle REQ socket connected to the given server, creating a new one
+        if this thread has none"""
+        try:
+            sockets = self._local.sockets
+        except AttributeError:
+            sockets = self._local.sockets = {}
+        endpoint = (self._gethostbyname(host), int(port))
+        idle = sockets.setdefault(endpoint, [])
+        if idle:
+            return endpoint, idle.pop()
+        context = SecureContext.instance(shared_secret=self.shared_secret)
+        sock = context.socket(zmq.REQ, allow_insecure=self.allow_insecure)
+        try:
+            # Allow up to 1 second to send unsent messages on socket shutdown:
+            sock.setsockopt(zmq.LINGER, 1000)
+            sock.connect(
+                'tcp://%s:%d' % endpoint,
+                timeout=None if timeout is None else timeout * 1000,
+                interruptor=interruptor,
+            )
+        except:
+            sock.close(linger=0)
+            raise
+        return endpoint, sock
+
+    def _checkin(self, endpoint, sock):
+        idle = self._local.sockets[endpoint]
+        if len(idle) < self.max_idle_sockets:
+            idle.append(sock)
+        else:
+            sock.close()
+
+    def get_many(
+        self,
+        requests,
+        timeout=5,
+        interruptor=None,
+        raise_server_exceptions=True,
+        dtype='pyobj',
+    ):
+        """Send each of the given requests, a list of (port, host, data) tuples, and
+        then gather the responses, returning a list of them in the same order. Requests
+        to the same server are sent on separate sockets, so are all in flight at once.
+        timeout applies separately to sending and to receiving all responses. If
+        raise_server_exceptions is True, the first exception returned by a server (in
+        the order of the requests) is raised once all responses have been received."""
+        requests = [
+            (port, host, _typecheck_or_convert_data(data, dtype))
+            for port, host, data in requests
+        ]
+        if interruptor is None:
+            interruptor = self.interruptor
+        send_method, recv_method = {
+            'raw': ('send', 'recv'),
+            'string': ('send_string', 'recv_string'),
+            'multipart': ('send_multipart', 'recv_multipart'),
+            'pyobj': ('send_pyobj', 'recv_pyobj'),
+        }[dtype]
+        send_kwargs = {'protocol': zprocess.PICKLE_PROTOCOL} if dtype == 'pyobj' else {}
+
+        def send(sock, data):
+            try:
+                getattr(sock, send_method)(data, zmq.NOBLOCK, **send_kwargs)
+            except zmq.ZMQError:
+                # Queue became full or we disconnected or something, keep polling, as
+                # zprocess's zmq_get() does:
+                return False
+
+        # Sockets in use, in request order, as (endpoint, sock):
+        in_use = []
+        responses = [None] * len(requests)
+        try:
+            for port, host, data in requests:
+                in_use.append(self._checkout(host, port, timeout, interruptor))
+        except:
+            # Nothing sent yet, so these sockets can be reused:
+            for endpoint, sock in in_use:
+                self._checkin(endpoint, sock)
+            raise
+        poller = zmq.Poller()
+        interruption_sock = interruptor.subscribe()
+        poller.register(interruption_sock, zmq.POLLIN)
+        try:
+            # Send all requests:
+            unsent = {sock: data for (_, sock), (_, _, data) in zip(in_use, requests)}
+            for sock in unsent:
+                poller.register(sock, zmq.POLLOUT)
+            msg = 'Could not send data to server: timed out'
+            self._poll_until_done(poller, unsent, interruption_sock, timeout, send, msg)
+            # Gather all responses:
+            indices = {sock: i for i, (_, sock) in enumerate(in_use)}
+            for sock in indices:
+                poller.register(sock, zmq.POLLIN)
+
+            def receive(sock, _):
+                responses[indices[sock]] = getattr(sock, recv_method)()
+
+            awaiting = dict.fromkeys(indices)
+            msg = 'No response from server: timed out'
+            self._poll_until_done(
+                poller, awaiting, interruption_sock, timeout, receive, msg
+            )
+        except:
+            # The request-reply cadence of these sockets may be broken. Discard them:
+            for _, sock in in_use:
+                sock.close(linger=0)
+            raise
+        finally:
+            poller.unregister(interruption_sock)
+            interruptor.unsubscribe()
+        for endpoint, sock in in_use:
+            self._checkin(endpoint, sock)
+        if raise_server_exceptions:
+            for response in responses:
+                if isinstance(response, Exception):
+                    raise response
+        return responses
+
+    @staticmethod
+    def _poll_until_done(poller, pending, interruption_sock, timeout, action, msg):
+        """Poll until each socket in the dict pending is ready, calling action(sock,
+        pending[sock]) for each and unregistering it, until none remain. If action
+        returns False, the socket remains pending and is polled again."""
+        if timeout is not None:
+            deadline = monotonic() + timeout
+        while pending:
+            if timeout is not None:
+                remaining = max(0, (deadline - monotonic()) * 1000)  # ms
+            else:
+                remaining = None
+            events = dict(poller.poll(remaining))
+            if not events:
+                raise TimeoutError(msg)
+            if interruption_sock in events:
+                raise zprocess.Interrupted(interruption_sock.recv().decode('utf8'))
+            for sock in events:
+                if action(sock, pending[sock]) is False:
+                    continue
+                del pending[sock]
+                poller.unregister(sock)
+
+
 class Context(SecureContext):
     """Subclass of zprocess.security.SecureContext configured with settings from
     labconfig, substitutable for a zmq.Context. Can be instantiated to get a unique
@@ -263,11 +513,238 @@ class Context(SecureContext):
         return SecureContext.socket(self, socket_type=socket_type, **kwargs)
 
 
+LOCK_STATS_DIR = os.path.join(LABSCRIPT_SUITE_PROFILE, 'logs', 'zlock_stats')
+
+
+class LockMetrics(object):
+    """Client-side statistics of zlock usage by this process, per lock key: the number
+    of acquisitions and failed acquisitions, the time spent waiting to acquire and
+    holding each lock, and how many times a lock was held for longer than its timeout,
+    such that the zlock server may have released it early.
+
+    Statistics are only recorded if the environment variable LABSCRIPT_ZLOCK_STATS is
+    set, or if enabled is set to True. Since lock keys include the paths of shot files,
+    only the max_keys most recently used keys are kept. The statistics of keys
+    discarded to make room for others are added to those of the key EVICTED_KEY.
+
+    If LABSCRIPT_ZLOCK_STATS is set, the statistics are also periodically written to a
+    file in LOCK_STATS_DIR, from which they can be read by other processes with
+    load_published() or by running:
+
+    .. code-block:: bash
+
+        python -m labscript_utils.zlock --stats
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+    publish_interval = 5
+    max_keys = 1000
+    EVICTED_KEY = '<other keys>'
+
+    def __init__(self):
+        self.enabled = bool(os.environ.get('LABSCRIPT_ZLOCK_STATS'))
+        self._lock = threading.Lock()
+        self._stats = OrderedDict()
+        self._changed = threading.Event()
+        self._publish_thread = None
+        self.filename = os.path.join(
+            LOCK_STATS_DIR, '%s-%d.json' % (socket.gethostname(), os.getpid())
+        )
+
+    @classmethod
+    def instance(cls):
+        if cls._instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    cls._instance = cls()
+                    if os.environ.get('LABSCRIPT_ZLOCK_STATS'):
+                        cls._instance.start_publishing()
+        return cls._instance
+
+    @staticmethod
+    def _new_stats():
+        return {
+            'acquisitions': 0,
+            'failures': 0,
+            'wait_total': 0.0,
+            'wait_max': 0.0,
+            'hold_total': 0.0,
+            'hold_max': 0.0,
+            'overheld': 0,
+        }
+
+    def _key_stats(self, key):
+        if isinstance(key, bytes):
+            key = key.decode('utf8', 'replace')
+        try:
+            stats = self._stats[key]
+        except KeyError:
+            stats = self._stats[key] = self._new_stats()
+            while len(self._stats) > self.max_keys:
+                self._evict_oldest()
+        else:
+            self._stats.move_to_end(key)
+        return stats
+
+    def _evict_oldest(self):
+        for key in self._stats:
+            if key != self.EVICTED_KEY:
+                break
+        stats = self._stats.pop(key)
+        total = self._stats.setdefault(self.EVICTED_KEY, self._new_stats())
+        self._stats.move_to_end(self.EVICTED_KEY, last=False)
+        for name, value in stats.items():
+            if name.endswith('_max'):
+                total[name] = max(total[name], value)
+            else:
+                total[name] += value
+
+    def record_acquire(self, key, wait, failed=False):
+        """Record that acquiring the lock for the given key took wait seconds, and
+        whether it failed with an exception"""
+        if not self.enabled:
+            return
+        with self._lock:
+            stats = self._key_stats(key)
+            if failed:
+                stats['failures'] += 1
+            else:
+                stats['acquisitions'] += 1
+            stats['wait_total'] += wait
+            stats['wait_max'] = max(stats['wait_max'], wait)
+        self._changed.set()
+
+    def record_release(self, key, hold, timeout):
+        """Record that the lock for the given key, acquired with the given timeout, was
+        held for hold seconds"""
+        if not self.enabled:
+            return
+        with self._lock:
+            stats = self._key_stats(key)
+            stats['hold_total'] += hold
+            stats['hold_max'] = max(stats['hold_max'], hold)
+            if hold > timeout:
+                stats['overheld'] += 1
+        self._changed.set()
+
+    def stats(self):
+        """Return a copy of the statistics as a dict of dicts, keyed by lock key"""
+        with self._lock:
+            return {key: dict(stats) for key, stats in self._stats.items()}
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+        self._changed.set()
+
+    def publish(self):
+        """Write the statistics to this process's file in LOCK_STATS_DIR"""
+        self._changed.clear()
+        data = {
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+            'program': sys.argv[0] if sys.argv else '',
+            'time': time(),
+            'locks': self.stats(),
+        }
+        _write_file_atomic(self.filename, json.dumps(data, indent=1))
+
+    def _publish_loop(self):
+        while True:
+            self._changed.wait()
+            self.publish()
+            # Rate limit writes:
+            sleep(self.publish_interval)
+
+    def start_publishing(self):
+        """Publish the statistics every publish_interval seconds if they have changed,
+        and at exit"""
+        if self._publish_thread is None:
+            self._publish_thread = threading.Thread(
+                target=self._publish_loop, name='LockMetrics publisher', daemon=True
+            )
+            self._publish_thread.start()
+            atexit.register(self.publish)
+
+    @classmethod
+    def load_published(cls):
+        """Return a list of the statistics published by all processes, as dicts with
+        keys 'host', 'pid', 'program', 'time' and 'locks'. Files that cannot be read
+        are skipped."""
+        results = []
+        try:
+            names = sorted(os.listdir(LOCK_STATS_DIR))
+        except FileNotFoundError:
+            return results
+        for name in names:
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(LOCK_STATS_DIR, name), encoding='utf8') as f:
+                    results.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return results
+
+    @classmethod
+    def merge(cls, all_stats):
+        """Combine an iterable of dicts of per-key statistics (as returned by stats())
+        into one"""
+        merged = {}
+        for stats in all_stats:
+            for key, key_stats in stats.items():
+                total = merged.setdefault(key, cls._new_stats())
+                for name, value in key_stats.items():
+                    if name.endswith('_max'):
+                        total[name] = max(total.get(name, 0), value)
+                    else:
+                        total[name] = total.get(name, 0) + value
+        return merged
+
+
+class MeteredLock(zprocess.zlock.Lock):
+    """A zprocess.zlock.Lock that records its acquire and hold times in
+    LockMetrics.instance()"""
+
+    def __init__(self, *args, **kwargs):
+        zprocess.zlock.Lock.__init__(self, *args, **kwargs)
+        self._metrics = LockMetrics.instance()
+        self._acquired_time = None
+        self._timeout = None
+
+    def acquire(self, timeout=None, read_only=None):
+        start_time = monotonic()
+        try:
+            zprocess.zlock.Lock.acquire(self, timeout, read_only)
+        except Exception:
+            self._metrics.record_acquire(self.key, monotonic() - start_time, True)
+            raise
+        self._acquired_time = monotonic()
+        if timeout is None:
+            timeout = self.client.default_timeout
+        self._timeout = timeout
+        self._metrics.record_acquire(self.key, self._acquired_time - start_time)
+
+    def release(self):
+        zprocess.zlock.Lock.release(self)
+        if self._acquired_time is not None:
+            hold = monotonic() - self._acquired_time
+            self._acquired_time = None
+            self._metrics.record_release(self.key, hold, self._timeout)
+
+
 def Lock(*args, **kwargs):
+    # If connecting to the zlock server in the background, wait until connected:
+    wait_for_zlock_server()
     if 'read_only' in kwargs and not _zlock_server_supports_readwrite:
         # Ignore read_only argument if the server does not support it:
         del kwargs['read_only']
-    return ProcessTree.instance().lock(*args, **kwargs)
+    process_tree = ProcessTree.instance()
+    if process_tree.zlock_client is None:
+        # Raises an exception saying zlock is not configured:
+        return process_tree.lock(*args, **kwargs)
+    return MeteredLock(process_tree.zlock_client, *args, **kwargs)
 
 
 def Event(*args, **kwargs):
@@ -279,35 +756,41 @@ def Handler(*args, **kwargs):
 
 
 def zmq_get(*args, **kwargs):
-    return ZMQClient.instance().get(*args, **kwargs)
+    return PooledZMQClient.instance().get(*args, **kwargs)
 
 
 def zmq_get_multipart(*args, **kwargs):
-    return ZMQClient.instance().get_multipart(*args, **kwargs)
+    return PooledZMQClient.instance().get_multipart(*args, **kwargs)
 
 
 def zmq_get_string(*args, **kwargs):
-    return ZMQClient.instance().get_string(*args, **kwargs)
+    return PooledZMQClient.instance().get_string(*args, **kwargs)
 
 
 def zmq_get_raw(*args, **kwargs):
-    return ZMQClient.instance().get_raw(*args, **kwargs)
+    return PooledZMQClient.instance().get_raw(*args, **kwargs)
+
+
+def zmq_get_many(requests, *args, **kwargs):
+    """Send many requests, a list of (port, host, data) tuples, before waiting for any
+    responses, and return the list of responses. See PooledZMQClient.get_many()"""
+    return PooledZMQClient.instance().get_many(requests, *args, **kwargs)
 
 
 def zmq_push(*args, **kwargs):
-    return ZMQClient.instance().push(*args, **kwargs)
+    return PooledZMQClient.instance().push(*args, **kwargs)
 
 
 def zmq_push_multipart(*args, **kwargs):
-    return ZMQClient.instance().push_multipart(*args, **kwargs)
+    return PooledZMQClient.instance().push_multipart(*args, **kwargs)
 
 
 def zmq_push_string(*args, **kwargs):
-    return ZMQClient.instance().push_string(*args, **kwargs)
+    return PooledZMQClient.instance().push_string(*args, **kwargs)
 
 
 def zmq_push_raw(*args, **kwargs):
-    return ZMQClient.instance().push_raw(*args, **kwargs)
+    return PooledZMQClient.instance().push_raw(*args, **kwargs)
 
 
 def RemoteProcessClient(host, port=None):
@@ -354,6 +837,50 @@ def connect_to_zlock_server():
     client.set_default_timeout(ZLOCK_DEFAULT_TIMEOUT)
 
 
+_zlock_connection_thread = None
+_zlock_connection_lock = threading.Lock()
+_zlock_connection_done = threading.Event()
+_zlock_connection_error = None
+
+
+def _connect_to_zlock_server_in_background():
+    global _zlock_connection_error
+    try:
+        connect_to_zlock_server()
+    except BaseException as e:
+        _zlock_connection_error = e
+    finally:
+        _zlock_connection_done.set()
+
+
+def connect_to_zlock_server_async():
+    """Like connect_to_zlock_server(), but connect (and start a zlock server on
+    localhost if required) in a background thread and return immediately. Lock() will
+    wait for the connection to complete if it has not already, and raise any exception
+    raised whilst connecting."""
+    global _zlock_connection_thread
+    with _zlock_connection_lock:
+        if _zlock_connection_thread is None:
+            _zlock_connection_thread = threading.Thread(
+                target=_connect_to_zlock_server_in_background,
+                name='connect_to_zlock_server',
+                daemon=True,
+            )
+            _zlock_connection_thread.start()
+
+
+def wait_for_zlock_server(timeout=None):
+    """If connect_to_zlock_server_async() has been called, block until the connection
+    to the zlock server has been made, and raise any exception raised whilst
+    connecting. Otherwise return immediately."""
+    if _zlock_connection_thread is None:
+        return
+    if not _zlock_connection_done.wait(timeout):
+        raise TimeoutError('Timed out waiting for connection to zlock server')
+    if _zlock_connection_error is not None:
+        raise _zlock_connection_error
+
+
 _connected_to_zlog = False
 
 
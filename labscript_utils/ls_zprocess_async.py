@@ -0,0 +1,524 @@
+#####################################################################
+#                                                                   #
+# ls_zprocess_async.py                                              #
+#                                                                   #
+# Copyright 2013, Monash University                                 #
+#                                                                   #
+# This file is part of the labscript suite (see                     #
+# http://labscriptsuite.org) and is licensed under the Simplified   #
+# BSD License. See the license.txt file in the root of the project  #
+# for the full license.                                             #
+#                                                                   #
+#####################################################################
+"""asyncio counterparts to the wrappers in labscript_utils.ls_zprocess, built on
+zmq.asyncio and configured from LabConfig in the same way, including the shared secret
+used for encryption. Use as:
+
+.. code-block:: python
+
+    from labscript_utils import ls_zprocess_async
+
+    response = await ls_zprocess_async.zmq_get(port, host, data)
+    async with ls_zprocess_async.Lock(key):
+        ...
+
+Sockets are created with the labscript_utils.ls_zprocess.Context, so that security is
+configured when they connect, and then wrapped for use with asyncio. Failure to
+authenticate with a server will therefore appear as a timeout rather than as an
+exception when connecting."""
+import os
+import pickle
+import asyncio
+import itertools
+import socket
+import weakref
+from time import monotonic
+from socket import gethostbyname
+from packaging.version import Version
+import zmq
+import zmq.asyncio
+
+import zprocess
+from zprocess.process_tree import EventBroker
+from labscript_utils.ls_zprocess import (
+    get_config,
+    Context,
+    ProcessTree,
+    LockMetrics,
+    ZLOCK_DEFAULT_TIMEOUT,
+    _typecheck_or_convert_data,
+)
+
+
+_SEND_RECV_METHODS = {
+    'raw': ('send', 'recv'),
+    'string': ('send_string', 'recv_string'),
+    'multipart': ('send_multipart', 'recv_multipart'),
+    'pyobj': ('send_pyobj', 'recv_pyobj'),
+}
+
+
+async def _gethostbyname(host, _cache={}):
+    # Cache name resolution, and do it in a thread so as not to block the event loop:
+    try:
+        return _cache[host]
+    except KeyError:
+        loop = asyncio.get_running_loop()
+        address = _cache[host] = await loop.run_in_executor(None, gethostbyname, host)
+        return address
+
+
+def _async_socket(socket_type, endpoint):
+    """Return a zmq.asyncio socket of the given type connected to the given (host,
+    port) endpoint, configured for security according to LabConfig"""
+    sock = Context.instance().socket(socket_type)
+    try:
+        sock.setsockopt(zmq.LINGER, 0)
+        sock.connect('tcp://%s:%d' % endpoint)
+        # The asyncio socket shadows the same underlying socket, and holds a reference
+        # to the original so that it is not garbage collected:
+        return zmq.asyncio.Socket.from_socket(sock)
+    except:
+        sock.close()
+        raise
+
+
+class ZMQClient(object):
+    """asyncio counterpart to labscript_utils.ls_zprocess.ZMQClient. Keeps a pool of
+    connected sockets per server, so that any number of requests may be in flight
+    concurrently. Sockets are bound to an event loop, so separate pools are kept for
+    each event loop. Call the .instance() classmethod to get a singleton."""
+
+    _instance = None
+
+    def __init__(self):
+        # {loop: {(socket_type, host, port): [idle sockets]}}:
+        self._pools = weakref.WeakKeyDictionary()
+
+    @classmethod
+    def instance(cls):
+        # Return previously initialised singleton:
+        if cls._instance is None:
+            # Create singleton:
+            cls._instance = cls()
+        return cls._instance
+
+    async def _checkout(self, socket_type, host, port):
+        loop = asyncio.get_running_loop()
+        pool = self._pools.setdefault(loop, {})
+        key = (socket_type, await _gethostbyname(host), int(port))
+        idle = pool.setdefault(key, [])
+        if idle:
+            return key, idle.pop()
+        return key, _async_socket(socket_type, key[1:])
+
+    def _checkin(self, key, sock):
+        self._pools[asyncio.get_running_loop()][key].append(sock)
+
+    async def _get(self, dtype, port, host, data, timeout, raise_server_exceptions):
+        data = _typecheck_or_convert_data(data, dtype)
+        send_method, recv_method = _SEND_RECV_METHODS[dtype]
+        key, sock = await self._checkout(zmq.REQ, host, port)
+        try:
+            try:
+                await asyncio.wait_for(getattr(sock, send_method)(data), timeout)
+            except asyncio.TimeoutError:
+                raise TimeoutError('Could not send data to server: timed out')
+            try:
+                response = await asyncio.wait_for(getattr(sock, recv_method)(), timeout)
+            except asyncio.TimeoutError:
+                raise TimeoutError('No response from server: timed out')
+        except BaseException:
+            # Including cancellation. The request-reply cadence of the socket may be
+            # broken, so don't reuse it:
+            sock.close(linger=0)
+            raise
+        self._checkin(key, sock)
+        if isinstance(response, Exception) and raise_server_exceptions:
+            raise response
+        return response
+
+    async def _push(self, dtype, port, host, data, timeout):
+        data = _typecheck_or_convert_data(data, dtype)
+        send_method, _ = _SEND_RECV_METHODS[dtype]
+        key, sock = await self._checkout(zmq.PUSH, host, port)
+        try:
+            await asyncio.wait_for(getattr(sock, send_method)(data), timeout)
+        except asyncio.TimeoutError:
+            sock.close(linger=0)
+            raise TimeoutError('Could not send data to server: timed out')
+        except BaseException:
+            sock.close(linger=0)
+            raise
+        self._checkin(key, sock)
+
+    async def get(
+        self, port, host='localhost', data=None, timeout=5, raise_server_exceptions=True
+    ):
+        return await self._get(
+            'pyobj', port, host, data, timeout, raise_server_exceptions
+        )
+
+    async def get_multipart(
+        self, port, host='localhost', data=None, timeout=5, raise_server_exceptions=True
+    ):
+        return await self._get(
+            'multipart', port, host, data, timeout, raise_server_exceptions
+        )
+
+    async def get_string(
+        self, port, host='localhost', data=None, timeout=5, raise_server_exceptions=True
+    ):
+        return await self._get(
+            'string', port, host, data, timeout, raise_server_exceptions
+        )
+
+    async def get_raw(
+        self, port, host='localhost', data=None, timeout=5, raise_server_exceptions=True
+    ):
+        return await self._get(
+            'raw', port, host, data, timeout, raise_server_exceptions
+        )
+
+    async def get_many(
+        self, requests, timeout=5, raise_server_exceptions=True, dtype='pyobj'
+    ):
+        """Make each of the given requests, a list of (port, host, data) tuples,
+        concurrently, and return a list of the responses in the same order. If
+        raise_server_exceptions is True, the first exception returned by a server (in
+        the order of the requests) is raised once all responses have been received."""
+        responses = await asyncio.gather(
+            *[
+                self._get(dtype, port, host, data, timeout, False)
+                for port, host, data in requests
+            ]
+        )
+        if raise_server_exceptions:
+            for response in responses:
+                if isinstance(response, Exception):
+                    raise response
+        return responses
+
+    async def push(self, port, host='localhost', data=None, timeout=5):
+        await self._push('pyobj', port, host, data, timeout)
+
+    async def push_multipart(self, port, host='localhost', data=None, timeout=5):
+        await self._push('multipart', port, host, data, timeout)
+
+    async def push_string(self, port, host='localhost', data=None, timeout=5):
+        await self._push('string', port, host, data, timeout)
+
+    async def push_raw(self, port, host='localhost', data=None, timeout=5):
+        await self._push('raw', port, host, data, timeout)
+
+
+class ZLockClient(object):
+    """asyncio client for the zlock server configured in LabConfig, implementing the
+    same protocol as zprocess.zlock.ZLockClient. Each acquisition uses a unique client
+    id, so that locks are exclusive between tasks in the same thread. Call the
+    .instance() classmethod to get a singleton."""
+
+    _instance = None
+
+    RESPONSE_TIMEOUT = 5
+
+    def __init__(self, host=None, port=None):
+        config = get_config()
+        self.host = config['zlock_host'] if host is None else host
+        self.port = config['zlock_port'] if port is None else port
+        self.default_timeout = ZLOCK_DEFAULT_TIMEOUT
+        self._supports_readwrite = None
+        self._ids = itertools.count()
+
+    @classmethod
+    def instance(cls):
+        # Return previously initialised singleton:
+        if cls._instance is None:
+            # Create singleton:
+            cls._instance = cls()
+        return cls._instance
+
+    def set_default_timeout(self, timeout):
+        self.default_timeout = timeout
+
+    def _make_client_id(self):
+        try:
+            task_name = asyncio.current_task().get_name()
+        except AttributeError:
+            task_name = 'task'
+        return ':'.join(
+            [
+                socket.gethostname(),
+                str(os.getpid()),
+                'asyncio-%s-%d' % (task_name, next(self._ids)),
+            ]
+        )
+
+    async def _request(self, messages, timeout=None):
+        if timeout is None:
+            timeout = self.RESPONSE_TIMEOUT
+        response = await ZMQClient.instance().get_multipart(
+            self.port, self.host, data=messages, timeout=timeout
+        )
+        return b''.join(response).decode('utf8')
+
+    async def ping(self, timeout=None):
+        """Ping the server to test for a response, returning the round trip time in
+        ms"""
+        loop = asyncio.get_running_loop()
+        start_time = loop.time()
+        response = await self._request([b'hello'], timeout)
+        if response != 'hello':
+            raise zmq.ZMQError('Invalid repsonse from server: ' + response)
+        return round((loop.time() - start_time) * 1000, 2)
+
+    async def get_protocol_version(self, timeout=None):
+        """Ask the server what protocol version it is running"""
+        response = await self._request([b'protocol'], timeout)
+        if 'KeyError' in response:
+            # What zlock said before it had the 'protocol' method, i.e. version 1.0.0
+            return '1.0.0'
+        return response
+
+    async def supports_readwrite(self):
+        """Return whether the server supports read-only locks, querying it only the
+        first time this is called"""
+        if self._supports_readwrite is None:
+            version = await self.get_protocol_version()
+            self._supports_readwrite = Version(version) >= Version('1.1.0')
+        return self._supports_readwrite
+
+    async def acquire(self, key, timeout=None, read_only=False):
+        """Acquire the lock with the given key, to be held for at most timeout seconds,
+        returning the client id with which it was acquired, which must be passed to
+        release()"""
+        if timeout is None:
+            timeout = self.default_timeout
+        client_id = self._make_client_id().encode('utf8')
+        messages = [b'acquire', key.encode('utf8'), client_id]
+        messages.append(str(timeout).encode('utf8'))
+        if read_only and await self.supports_readwrite():
+            messages.append(b'read_only')
+        while True:
+            # timeout is how long the server will let us hold the lock. If the lock is
+            # not free, the server responds promptly with 'retry' and we ask again:
+            response = await self._request(messages)
+            if response == 'ok':
+                return client_id
+            elif response != 'retry':
+                raise zmq.ZMQError(response)
+
+    async def release(self, key, client_id):
+        response = await self._request([b'release', key.encode('utf8'), client_id])
+        if response != 'ok':
+            raise zmq.ZMQError(response)
+
+    def lock(self, key, read_only=False):
+        return _Lock(self, key, read_only=read_only)
+
+
+class _Lock(object):
+    """asyncio counterpart to zprocess.zlock.Lock, usable with async with"""
+
+    def __init__(self, client, key, read_only=False):
+        self.client = client
+        self.key = key
+        self.read_only = read_only
+        self._client_id = None
+        self._metrics = LockMetrics.instance()
+        self._acquired_time = None
+        self._timeout = None
+
+    async def acquire(self, timeout=None, read_only=None):
+        if read_only is None:
+            read_only = self.read_only
+        start_time = monotonic()
+        try:
+            self._client_id = await self.client.acquire(self.key, timeout, read_only)
+        except Exception:
+            self._metrics.record_acquire(self.key, monotonic() - start_time, True)
+            raise
+        self._acquired_time = monotonic()
+        if timeout is None:
+            timeout = self.client.default_timeout
+        self._timeout = timeout
+        self._metrics.record_acquire(self.key, self._acquired_time - start_time)
+
+    async def release(self):
+        await self.client.release(self.key, self._client_id)
+        self._client_id = None
+        if self._acquired_time is not None:
+            hold = monotonic() - self._acquired_time
+            self._acquired_time = None
+            self._metrics.record_release(self.key, hold, self._timeout)
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        await self.release()
+
+
+class _Event(object):
+    """asyncio counterpart to zprocess.process_tree.Event, using the event broker of
+    the ProcessTree configured from LabConfig. Use the Event() coroutine function of
+    this module to create one."""
+
+    def __init__(self, event_name, role='wait'):
+        self.event_name = event_name
+        # Null terminate the event name, otherwise we would also receive events whose
+        # names merely start with our event name:
+        self._encoded_event_name = self.event_name.encode('utf8') + b'\0'
+        if not role in ['wait', 'post', 'both']:
+            raise ValueError("role must be 'wait', 'post', or 'both'")
+        self.role = role
+        self.can_wait = self.role in ['wait', 'both']
+        self.can_post = self.role in ['post', 'both']
+        self.sub = None
+        self.push = None
+
+    async def _connect(self):
+        process_tree = ProcessTree.instance()
+        process_tree.check_broker()
+        broker_ip = await _gethostbyname(process_tree.broker_host)
+        if self.can_wait:
+            self.sub = _async_socket(
+                zmq.SUB, (broker_ip, process_tree.broker_out_port)
+            )
+            self.sub.set_hwm(1000)
+            self.sub.setsockopt(zmq.SUBSCRIBE, self._encoded_event_name)
+            # As in zprocess, wait for a welcome message from the broker confirming it
+            # has processed our subscription, so that any events posted after we
+            # return are guaranteed to be received:
+            welcome = EventBroker.WELCOME_MESSAGE + os.urandom(32)
+            self.sub.setsockopt(zmq.SUBSCRIBE, welcome)
+            try:
+                while await asyncio.wait_for(self.sub.recv(), 5) != welcome:
+                    pass
+            except asyncio.TimeoutError:
+                raise TimeoutError("Could not connect to event broker")
+            self.sub.setsockopt(zmq.UNSUBSCRIBE, welcome)
+        if self.can_post:
+            self.push = _async_socket(
+                zmq.PUSH, (broker_ip, process_tree.broker_in_port)
+            )
+
+    async def post(self, identifier, data=None):
+        if not self.can_post:
+            msg = (
+                "Instantiate Event with role='post' "
+                + "or 'both' to be able to post events"
+            )
+            raise ValueError(msg)
+        await self.push.send_multipart(
+            [
+                self._encoded_event_name,
+                str(identifier).encode('utf8'),
+                pickle.dumps(data, protocol=zprocess.PICKLE_PROTOCOL),
+            ]
+        )
+
+    async def wait(self, identifier, timeout=None):
+        if not self.can_wait:
+            msg = (
+                "Instantiate Event with role='wait' "
+                + "or 'both' to be able to wait for events"
+            )
+            raise ValueError(msg)
+        identifier = str(identifier)
+
+        async def receive():
+            while True:
+                encoded_event_name, event_id, data = await self.sub.recv_multipart()
+                assert encoded_event_name == self._encoded_event_name
+                if event_id.decode('utf8') == identifier:
+                    return pickle.loads(data)
+
+        try:
+            return await asyncio.wait_for(receive(), timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError('No event received: timed out')
+
+
+class RemoteProcessClient(object):
+    """asyncio counterpart to zprocess.remote.RemoteProcessClient for making requests
+    of a remote process server, configured from LabConfig. Does not support Popen(),
+    since the returned process proxy is blocking; use
+    labscript_utils.ls_zprocess.RemoteProcessClient for starting remote processes."""
+
+    def __init__(self, host, port=None):
+        if port is None:
+            config = get_config()
+            port = config['zprocess_remote_port']
+        self.host = host
+        self.port = port
+
+    async def request(self, command, *args, **kwargs):
+        get_kwargs = {}
+        for kwarg in kwargs.copy():
+            if kwarg.startswith('get_'):
+                get_kwargs[kwarg.split('get_')[1]] = kwargs.pop(kwarg)
+        return await ZMQClient.instance().get(
+            self.port, self.host, data=[command, args, kwargs], **get_kwargs
+        )
+
+    async def say_hello(self, **kwargs):
+        return await self.request('hello', **kwargs)
+
+    async def get_external_IP(self, **kwargs):
+        """Ask the RemoteProcessServer what our IP address is from its perspective"""
+        return await self.request('whoami', **kwargs)
+
+    async def get_protocol(self, **kwargs):
+        return await self.request('protocol', **kwargs)
+
+
+def Lock(key, read_only=False):
+    """Return a lock on the given key from the zlock server configured in LabConfig,
+    for use with async with"""
+    return ZLockClient.instance().lock(key, read_only=read_only)
+
+
+async def Event(event_name, role='wait'):
+    """Return an Event connected to the event broker of the ProcessTree configured
+    from LabConfig"""
+    event = _Event(event_name, role=role)
+    await event._connect()
+    return event
+
+
+async def zmq_get(*args, **kwargs):
+    return await ZMQClient.instance().get(*args, **kwargs)
+
+
+async def zmq_get_multipart(*args, **kwargs):
+    return await ZMQClient.instance().get_multipart(*args, **kwargs)
+
+
+async def zmq_get_string(*args, **kwargs):
+    return await ZMQClient.instance().get_string(*args, **kwargs)
+
+
+async def zmq_get_raw(*args, **kwargs):
+    return await ZMQClient.instance().get_raw(*args, **kwargs)
+
+
+async def zmq_get_many(requests, *args, **kwargs):
+    return await ZMQClient.instance().get_many(requests, *args, **kwargs)
+
+
+async def zmq_push(*args, **kwargs):
+    return await ZMQClient.instance().push(*args, **kwargs)
+
+
+async def zmq_push_multipart(*args, **kwargs):
+    return await ZMQClient.instance().push_multipart(*args, **kwargs)
+
+
+async def zmq_push_string(*args, **kwargs):
+    return await ZMQClient.instance().push_string(*args, **kwargs)
+
+
+async def zmq_push_raw(*args, **kwargs):
+    return await ZMQClient.instance().push_raw(*args, **kwargs)
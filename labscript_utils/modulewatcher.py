@@ -15,6 +15,7 @@ import threading
 import time
 import os
 import site
+import hashlib
 import sysconfig
 
 
@@ -39,9 +40,15 @@ class ModuleWatcher(object):
     Args:
         debug (bool, optional): When :code:`True`, prints debugging information
             when reloading modules.
+        use_hashes (bool, optional): When :code:`True`, modification is detected by
+            an MD5 hash of each file's contents rather than its modified time, so
+            that touching a file or rewriting it with identical contents does not
+            trigger a reload. Files are only re-hashed when their size or modified
+            time changes.
     """
-    def __init__(self, debug=False):
+    def __init__(self, debug=False, use_hashes=False):
         self.debug = debug
+        self.use_hashes = use_hashes
         # A lock to hold whenever you don't want modules unloaded:
         self.lock = threading.Lock()
 
@@ -49,6 +56,9 @@ class ModuleWatcher(object):
         self.whitelist = set(sys.modules)
         self.meta_whitelist = list(sys.meta_path)
         self.modified_times = {}
+        # Cache of file hashes, keyed by filepath, with values (signature, hash) where
+        # signature is the (size, mtime) of the file when it was hashed:
+        self.hash_cache = {}
         self.main = threading.Thread(target=self.mainloop)
         self.main.daemon = True
         self.main.start()
@@ -84,8 +94,8 @@ class ModuleWatcher(object):
                     # Whitelist modules in package install directories:
                     self.whitelist.add(name)
                     continue
-                # Check and store the modified time of the .py file:
-                modified_time = os.path.getmtime(module_file)
+                # Check and store the modified time (or hash) of the .py file:
+                modified_time = self._modified_info_of_file(module_file)
                 previous_modified_time = self.modified_times.setdefault(
                     name, modified_time
                 )
@@ -101,6 +111,22 @@ class ModuleWatcher(object):
                     sys.stderr.write(message)
         return unload_required
 
+    def _modified_info_of_file(self, module_file):
+        """Return the modified time of the file, or if self.use_hashes is True, a hash
+        of its contents. Hashes are cached and only recomputed if the size or modified
+        time of the file has changed since it was last hashed"""
+        stat = os.stat(module_file)
+        if not self.use_hashes:
+            return stat.st_mtime
+        signature = (stat.st_size, stat.st_mtime)
+        cached = self.hash_cache.get(module_file)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        with open(module_file, 'rb') as f:
+            file_hash = hashlib.md5(f.read()).hexdigest()
+        self.hash_cache[module_file] = (signature, file_hash)
+        return file_hash
+
     def unload(self):
         if self.debug:
             print("ModuleWatcher: whitelist is:")
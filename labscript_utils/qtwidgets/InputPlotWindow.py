@@ -24,7 +24,7 @@ class PlotWindow(Process):
             title = "{}".format(self._hardware_name)
         self.plot_win = pg.plot([], title=title)
 
-        broker_pub_port = int(LabConfig().get('ports', 'BLACS_Broker_Pub'))
+        broker_pub_port = int(LabConfig.instance().get('ports', 'BLACS_Broker_Pub'))
         context = zmq.Context()
         self.socket = context.socket(zmq.SUB)
         self.socket.connect("tcp://127.0.0.1:%d" % broker_pub_port)
@@ -10,33 +10,208 @@
 # for the full license.                                             #
 #                                                                   #
 #####################################################################
+"""Translation of paths on shared drives between local paths and 'network agnostic'
+paths of the form 'Z:\\path\\to\\file', which can be sent between computers that mount
+the same shared drive at different locations.
+
+Configuration is read from labconfig on first use and cached. Call reload() to pick up
+changes to labconfig in a long-running process.
+
+The shared drive mapped to 'Z:\\' is set by the 'shared_drive' key in the [paths]
+section of labconfig. Additional shared drives can be mapped to other agnostic drive
+letters with a [shared_drives] section, for example:
+
+.. code-block:: ini
+
+    [shared_drives]
+    y = /mnt/camera_data
+    x = /mnt/archive
+"""
 import os
+import threading
+from functools import lru_cache
 from labscript_utils.labconfig import LabConfig
 
-_config = LabConfig(required_params={'paths':['shared_drive']})
-prefix = _config.get('paths','shared_drive')
+AGNOSTIC_DRIVE = 'Z:\\'
+_AGNOSTIC_SEP = '\\'
+
+
+def _split(path, sep):
+    """Split a path into its components, ignoring any trailing separator"""
+    components = path.split(sep)
+    if len(components) > 1 and not components[-1]:
+        del components[-1]
+    return components
+
+
+class _PrefixTrie(object):
+    """A trie of path components, for finding the longest of a set of prefixes that a
+    path begins with, in time independent of the number of prefixes"""
+
+    def __init__(self, sep):
+        self.sep = sep
+        self.root = {}
+        # Key under which the value for a complete prefix is stored within a node.
+        # Can't clash with a path component, which is always a string:
+        self._terminal = None
+
+    def insert(self, prefix, value):
+        node = self.root
+        for component in _split(prefix, self.sep):
+            node = node.setdefault(component, {})
+        node[self._terminal] = value
+
+    def match(self, path):
+        """Return (value, remainder), where value is the value of the longest prefix
+        matching the path, and remainder is the list of path components following
+        it. Returns (None, None) if no prefix matches."""
+        components = _split(path, self.sep)
+        node = self.root
+        match = None, None
+        for i, component in enumerate(components):
+            node = node.get(component)
+            if node is None:
+                break
+            if self._terminal in node:
+                match = node[self._terminal], components[i + 1 :]
+        return match
+
+
+class SharedDriveTranslator(object):
+    """Translates paths between local and network agnostic forms for any number of
+    shared drives. Prefixes are matched by longest prefix, and recent translations are
+    cached.
+
+    Args:
+        mappings (dict): mapping of agnostic drives (such as :code:`'Z:\\\\'`) to
+            the local path at which each is mounted on this computer.
+        cache_size (int, optional): Number of recent translations to cache in each
+            direction.
+    """
+
+    def __init__(self, mappings, cache_size=1024):
+        self.mappings = {}
+        self._local_trie = _PrefixTrie(os.path.sep)
+        self._agnostic_trie = _PrefixTrie(_AGNOSTIC_SEP)
+        for drive, local_prefix in mappings.items():
+            if not drive.endswith(_AGNOSTIC_SEP):
+                drive += _AGNOSTIC_SEP
+            # ensure prefix ends with a slash:
+            if not local_prefix.endswith(os.path.sep):
+                local_prefix += os.path.sep
+            self.mappings[drive] = local_prefix
+            self._local_trie.insert(local_prefix, drive)
+            self._agnostic_trie.insert(drive, local_prefix)
+        self._to_agnostic = lru_cache(maxsize=cache_size)(self._to_agnostic)
+        self._to_local = lru_cache(maxsize=cache_size)(self._to_local)
+
+    @classmethod
+    def from_labconfig(cls, config=None, **kwargs):
+        """Create a translator for the shared drives configured in the given
+        LabConfig, or the default LabConfig if None"""
+        if config is None:
+            config = LabConfig.instance(required_params={'paths': ['shared_drive']})
+        mappings = {AGNOSTIC_DRIVE: config.get('paths', 'shared_drive')}
+        if config.has_section('shared_drives'):
+            defaults = config.defaults()
+            for letter in config.options('shared_drives'):
+                # Skip keys that are merely inherited from the DEFAULT section:
+                if letter in defaults:
+                    continue
+                drive = letter.upper() + ':' + _AGNOSTIC_SEP
+                mappings[drive] = config.get('shared_drives', letter)
+        return cls(mappings, **kwargs)
+
+    def _to_agnostic(self, path):
+        path = os.path.normpath(path)
+        drive, remainder = self._local_trie.match(path)
+        if drive is None:
+            return path
+        return drive + _AGNOSTIC_SEP.join(remainder)
+
+    def _to_local(self, path):
+        local_prefix, remainder = self._agnostic_trie.match(path)
+        if local_prefix is None:
+            return path
+        return os.path.join(local_prefix, os.path.sep.join(remainder))
+
+    def path_to_agnostic(self, path):
+        """Return the network agnostic form of a local path. Paths not on a shared
+        drive are returned as absolute paths, but otherwise unmodified."""
+        # Relative paths depend on the current working directory, so make them
+        # absolute outside the cache:
+        if not os.path.isabs(path):
+            path = os.path.abspath(path)
+        return self._to_agnostic(path)
+
+    def path_to_local(self, path):
+        """Return the local form of a network agnostic path. Paths not on a known
+        agnostic drive are returned unmodified."""
+        return self._to_local(path)
+
+    def translate_many(self, paths, to='local'):
+        """Translate a list of paths. to must be 'local' or 'agnostic'."""
+        if to == 'local':
+            translate = self.path_to_local
+        elif to == 'agnostic':
+            translate = self.path_to_agnostic
+        else:
+            raise ValueError("to must be 'local' or 'agnostic', not %r" % to)
+        return [translate(path) for path in paths]
+
+    def cache_clear(self):
+        """Clear the caches of recent translations"""
+        self._to_agnostic.cache_clear()
+        self._to_local.cache_clear()
+
+
+# The translator configured from labconfig is created on first use rather than at
+# import time, so that importing this module is cheap and does not require labconfig:
+_translator = None
+_translator_lock = threading.Lock()
+
+
+def get_translator():
+    """Return the SharedDriveTranslator configured from labconfig, reading labconfig
+    the first time this is called."""
+    global _translator
+    if _translator is None:
+        with _translator_lock:
+            if _translator is None:
+                _translator = SharedDriveTranslator.from_labconfig()
+    return _translator
+
+
+def reload():
+    """Re-read the shared drive configuration from labconfig, so that long-running
+    processes can pick up changes to it. Returns the new translator."""
+    global _translator
+    translator = SharedDriveTranslator.from_labconfig()
+    with _translator_lock:
+        _translator = translator
+    return translator
+
+
+def __getattr__(name):
+    # Backward compatibility for code accessing the module-level prefix or translator
+    if name == 'prefix':
+        return get_translator().mappings[AGNOSTIC_DRIVE]
+    if name == 'translator':
+        return get_translator()
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
 
-# ensure prefix ends with a slash:
-if not prefix.endswith(os.path.sep):
-    prefix += os.path.sep
-    
 def path_to_agnostic(path):
-    path = os.path.abspath(path)
-    if path.startswith(prefix):
-        path = path.split(prefix, 1)[1]
-        path = 'Z:\\' + path
-        path = path.replace(os.path.sep, '\\')
-    return path
-    
+    return get_translator().path_to_agnostic(path)
+
+
 def path_to_local(path):
-    if path.startswith('Z:\\'):
-        path = path.split('Z:\\', 1)[1]
-        path = path.replace('\\', os.path.sep)
-        path = os.path.join(prefix, path)
-    return path
+    return get_translator().path_to_local(path)
+
 
 if __name__ == '__main__':
-    # test: 
+    # test:
+    prefix = get_translator().mappings[AGNOSTIC_DRIVE]
     path = os.path.join(prefix, 'foo','bar','baz')
     agnostic_path = path_to_agnostic(path)
     local_path = path_to_local(agnostic_path)
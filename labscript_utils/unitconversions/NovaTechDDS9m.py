@@ -25,9 +25,11 @@ class NovaTechDDS9mFreqConversion(UnitConversion):
             self.derived_units = ['MHz']        
         UnitConversion.__init__(self,self.parameters)
 
+    @affine
     def MHz_to_base(self,MHz):
         Hz = MHz*10.0**6
         return Hz
+    @affine
     def MHz_from_base(self,Hz):
         MHz = Hz/10.0**6
         return MHz
@@ -47,9 +49,11 @@ class NovaTechDDS9mAmpConversion(UnitConversion):
         
         UnitConversion.__init__(self,self.parameters)
 
+    @affine
     def hardware_to_base(self,hardware):
         arb = hardware/1023.0
         return arb
+    @affine
     def hardware_from_base(self,arb):
         hardware = arb*1023.0
         return hardware
@@ -14,6 +14,7 @@
 import copy
 from types import MethodType
 import math
+import numpy as np
 from numpy import iterable, array
 
 
@@ -37,6 +38,17 @@ class _MultiplicativeConversion(object):
             return self.unprefixed_method(value) / self.factor
 
 
+def affine(method):
+    """Decorator declaring that a conversion method (<unit>_to_base() or
+    <unit>_from_base()) is an affine function a*x + b of its argument, where a and b
+    may depend on self.parameters but not on the argument. UnitConversion.converter()
+    and convert() evaluate conversions between units whose methods are all declared
+    affine as a single a*x + b. Do not use on methods that clip, or that are piecewise
+    or otherwise nonlinear."""
+    method._affine = True
+    return method
+
+
 def vectorise(method):
     def f(instance, arg):
         if iterable(arg):
@@ -88,3 +100,116 @@ class UnitConversion(object):
         self.derived_units = [unit for sortinfo, unit in derived_units_sortlist]
 
         self.units = self._magnitudes # alias for backward compat
+
+    def _unprefixed_methods(self, unit):
+        """Return the to_base and from_base methods of the given unit with any magnitude
+        prefix stripped, and the magnitude of the prefix. For the base unit the methods
+        are None and the magnitude 1."""
+        if unit == self.base_unit:
+            return None, None, 1.0
+        if unit not in self.derived_units:
+            msg = "Unit %s is not the base unit %s or one of the derived units %s"
+            derived_units = ', '.join(self.derived_units)
+            raise ValueError(msg % (unit, self.base_unit, derived_units))
+        to_base = getattr(self, unit + "_to_base")
+        from_base = getattr(self, unit + "_from_base")
+        factor = 1.0
+        if isinstance(to_base, _MultiplicativeConversion):
+            factor = to_base.factor
+            to_base = to_base.unprefixed_method
+        if isinstance(from_base, _MultiplicativeConversion):
+            from_base = from_base.unprefixed_method
+        return to_base, from_base, factor
+
+    def _conversion(self, from_unit, to_unit):
+        """Return a function converting from from_unit to to_unit, and its coefficients
+        (a, b) if it is affine, otherwise None. Cached per instance until
+        clear_conversion_cache() is called."""
+        conversions = self.__dict__.setdefault('_conversions', {})
+        try:
+            return conversions[from_unit, to_unit]
+        except KeyError:
+            pass
+        if from_unit == to_unit:
+            self._unprefixed_methods(from_unit)  # Check it's a valid unit
+            return (lambda value: value), (1.0, 0.0)
+        to_base, _, to_base_factor = self._unprefixed_methods(from_unit)
+        _, from_base, from_base_factor = self._unprefixed_methods(to_unit)
+        from_base_factor = 1.0 / from_base_factor
+
+        if to_base is None:
+            def convert(value):
+                return from_base(value) * from_base_factor
+        elif from_base is None:
+            def convert(value):
+                return to_base(value * to_base_factor)
+        else:
+            def convert(value):
+                return from_base(to_base(value * to_base_factor)) * from_base_factor
+
+        methods = [method for method in (to_base, from_base) if method is not None]
+        coefficients = None
+        if all(getattr(method, '_affine', False) for method in methods):
+            # Since the conversion is affine, two points determine it:
+            b = float(convert(0.0))
+            a = float(convert(1.0)) - b
+            coefficients = a, b
+            if b == 0:
+                def convert(value):
+                    return a * value
+            else:
+                def convert(value):
+                    return a * value + b
+
+        conversions[from_unit, to_unit] = convert, coefficients
+        return convert, coefficients
+
+    def __setattr__(self, name, value):
+        if name == 'parameters':
+            self.clear_conversion_cache()
+        object.__setattr__(self, name, value)
+
+    def clear_conversion_cache(self):
+        """Discard the conversions cached by convert(), so that they are recreated from
+        the current self.parameters. This is done automatically when self.parameters is
+        assigned to, but must be called explicitly after modifying it in place, since
+        the coefficients of affine conversions are computed from it only once."""
+        self.__dict__.pop('_conversions', None)
+
+    def converter(self, from_unit, to_unit):
+        """Return a function that converts values from from_unit to to_unit. Either may
+        be the base unit or any derived unit including those with magnitude prefixes.
+        This is equivalent to calling <from_unit>_to_base() followed by
+        <to_unit>_from_base(), but calls the unprefixed conversion methods directly with
+        the magnitudes of any prefixes folded into a single multiplication each. If all
+        the conversion methods involved are declared affine with the @affine decorator,
+        the conversion is instead a single evaluation of a*x + b, which may differ from
+        calling the conversion methods by floating point rounding.
+        Keep the returned function around if converting many times, such as in a loop.
+        Note that a and b are computed from self.parameters when the function is
+        created, and it does not reflect subsequent changes to them."""
+        convert, _ = self._conversion(from_unit, to_unit)
+        return convert
+
+    def convert(self, value, from_unit, to_unit, inplace=False):
+        """Convert value from from_unit to to_unit, using the function returned by
+        converter(from_unit, to_unit), which is cached. If self.parameters is modified
+        in place, call clear_conversion_cache() afterwards. If inplace is True, value
+        must be a floating point numpy array, and the result is written into it and
+        returned. For affine conversions this is done without allocating any
+        intermediate arrays."""
+        convert, coefficients = self._conversion(from_unit, to_unit)
+        if not inplace:
+            return convert(value)
+        if not (isinstance(value, np.ndarray) and value.dtype.kind == 'f'):
+            msg = "inplace conversion requires a floating point numpy array, not %s"
+            raise TypeError(msg % type(value).__name__)
+        if coefficients is None:
+            value[...] = convert(value)
+            return value
+        a, b = coefficients
+        if a != 1:
+            np.multiply(value, a, out=value)
+        if b != 0:
+            np.add(value, b, out=value)
+        return value
@@ -65,8 +65,9 @@ class SineAom(NovaTechDDS9mAmpConversion):
         f = self.parameters["f"]
         phase = self.parameters["phase"]
         
-        if 2*pi*f*amp + phase > 2*pi:
-            amp = (2*pi - phase) / (2*pi*f)
+        # Evaluated on whole arrays at once. [()] converts 0d arrays back to scalars:
+        amp = asarray(amp, dtype=float)
+        amp = where(2*pi*f*amp + phase > 2*pi, (2*pi - phase) / (2*pi*f), amp)[()]
         
         P = self.Power_from_base(amp)
         Pmax = self.parameters["A"] + self.parameters["c"]
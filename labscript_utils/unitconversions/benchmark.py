@@ -0,0 +1,103 @@
+#####################################################################
+#                                                                   #
+# benchmark.py                                                      #
+#                                                                   #
+# Copyright 2013, Monash University                                 #
+#                                                                   #
+# This file is part of the labscript suite (see                     #
+# http://labscriptsuite.org) and is licensed under the Simplified   #
+# BSD License. See the license.txt file in the root of the project  #
+# for the full license.                                             #
+#                                                                   #
+#####################################################################
+"""Benchmark of the unit conversion classes in this package, comparing evaluating
+conversions on whole arrays against evaluating them one element at a time, as the
+vectorise() decorator does for conversion methods that only accept scalars.
+
+Run with:
+
+    python -m labscript_utils.unitconversions.benchmark [-n N_POINTS]
+"""
+import time
+import functools
+import numpy as np
+
+from .UnitConversionBase import vectorise
+
+# Nothing to export - don't let the backward compat import * in __init__.py pick up
+# anything from this module:
+__all__ = []
+
+
+def _cases():
+    """Return (label, method, test values) for each conversion to benchmark"""
+    from .quad_driver import quad_driver
+    from .aom import SineAom
+    from .optotunelens import OptotuneLens
+    from .detuning import detuning
+    from .NovaTechDDS9m import NovaTechDDS9mFreqConversion
+
+    quad = quad_driver({})
+    aom = SineAom({})
+    lens = OptotuneLens({'a': 1.0, 'b': 2.0, 'c': 3.0})
+    det = detuning({'pass': 2, 'aom_f0': 80})
+    dds = NovaTechDDS9mFreqConversion({})
+    return [
+        ('quad_driver.A_to_base', quad.A_to_base, (-1, 20)),
+        ('quad_driver.Gcm_from_base', quad.Gcm_from_base, (-1, 1)),
+        ('SineAom.Power_to_base', aom.Power_to_base, (0.5, 3.5)),
+        ('SineAom.fraction_from_base', aom.fraction_from_base, (0, 1)),
+        ('OptotuneLens.distance_to_base', lens.distance_to_base, (0, 10)),
+        ('OptotuneLens.distance_from_base', lens.distance_from_base, (-1, 10)),
+        ('detuning.d_MHz_to_base', det.d_MHz_to_base, (-20, 20)),
+        ('NovaTechDDS9mFreq.MHz_to_base', dds.MHz_to_base, (0, 170)),
+    ]
+
+
+def _time(f, arg, repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f(arg)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def benchmark(n_points=1000000, n_elementwise=10000):
+    """Time each conversion on an array of n_points values, and on n_elementwise
+    values one element at a time (extrapolated to n_points). Check the results agree.
+    Return a list of (label, array time, element-wise time) in seconds."""
+    results = []
+    for label, method, (lo, hi) in _cases():
+        values = np.linspace(lo, hi, n_points)
+        some_values = values[:: max(n_points // n_elementwise, 1)]
+        elementwise = functools.partial(vectorise(lambda _, value: method(value)), None)
+        expected = elementwise(some_values)
+        assert np.allclose(method(some_values), expected, equal_nan=True), label
+        t_array = _time(method, values)
+        t_elementwise = _time(elementwise, some_values, repeat=1)
+        t_elementwise *= n_points / len(some_values)
+        results.append((label, t_array, t_elementwise))
+    return results
+
+
+def print_benchmark_results(results, n_points):
+    print('Conversion of %d points:' % n_points)
+    print('%-34s %12s %18s %9s' % ('', 'array (ms)', 'per-element (ms)', 'speedup'))
+    for label, t_array, t_elementwise in results:
+        speedup = t_elementwise / t_array
+        print(
+            '%-34s %12.1f %18.1f %8.0fx'
+            % (label, 1e3 * t_array, 1e3 * t_elementwise, speedup)
+        )
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--n-points', type=int, default=1000000)
+    args = parser.parse_args()
+    with np.errstate(all='ignore'):
+        results = benchmark(args.n_points)
+    print_benchmark_results(results, args.n_points)
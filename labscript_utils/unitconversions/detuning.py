@@ -26,12 +26,15 @@ class detuning(UnitConversion):
         
         UnitConversion.__init__(self,self.parameters)
 
+    @affine
     def MHz_to_base(self, aom_frequency_MHz):
         return 1e6*aom_frequency_MHz
         
+    @affine
     def MHz_from_base(self, aom_frequency):
         return 1e-6*aom_frequency
         
+    @affine
     def d_MHz_to_base(self, detuning_MHz):
         if not self.parameters['aom_f0']:
             aom_frequency_MHz = (detuning_MHz - self.parameters['detuning_0'])/self.parameters['pass']
@@ -39,6 +42,7 @@ class detuning(UnitConversion):
             aom_frequency_MHz = detuning_MHz/self.parameters['pass'] + self.parameters['aom_f0']
         return self.MHz_to_base(aom_frequency_MHz)
         
+    @affine
     def d_MHz_from_base(self, aom_frequency):
         aom_frequency_MHz = self.MHz_from_base(aom_frequency)
         if not self.parameters['aom_f0']:
@@ -47,10 +51,12 @@ class detuning(UnitConversion):
             detuning_MHz = self.parameters['pass']*(aom_frequency_MHz - self.parameters['aom_f0']) 
         return detuning_MHz
         
+    @affine
     def linewidths_to_base(self, linewidths):
         aom_frequency = self.d_MHz_to_base(self.parameters['gamma'] * linewidths)
         return aom_frequency
         
+    @affine
     def linewidths_from_base(self, aom_frequency):
         linewidths = self.d_MHz_from_base(aom_frequency) / self.parameters['gamma']
         return linewidths
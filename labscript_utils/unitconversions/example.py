@@ -33,18 +33,25 @@ class example1(UnitConversion):
         
         UnitConversion.__init__(self,self.parameters)
 
+    # Conversion methods that are of the form a*x + b can be marked with the @affine
+    # decorator, so that converting between units with UnitConversion.convert() can be
+    # done with a single multiply-add.
+    @affine
     def A_to_base(self,amps):
         #here is the calibration code that may use self.parameters
         volts = amps/self.parameters['a']
         return volts
+    @affine
     def A_from_base(self,volts):
         #here is the calibration code that may use self.parameters
         amps = volts * self.parameters['a']
         return amps
+    @affine
     def Gauss_to_base(self,gauss):
         #here is the calibration code that may use self.parameters
         volts = gauss/self.parameters['b']
         return volts
+    @affine
     def Gauss_from_base(self,volts):
         #here is the calibration code that may use self.parameters
         gauss = (volts)*self.parameters['b']
@@ -70,10 +77,12 @@ class example2(UnitConversion):
         
         UnitConversion.__init__(self,self.parameters)
 
+    @affine
     def detuned_MHz_to_base(self,d_mhz):
         #here is the calibration code that may use self.parameters
         mhz = d_mhz - self.parameters['offset']
         return mhz
+    @affine
     def detuned_MHz_from_base(self,mhz):
         #here is the calibration code that may use self.parameters
         d_mhz = mhz + self.parameters['offset']
@@ -100,10 +109,12 @@ class example3(UnitConversion):
         
         UnitConversion.__init__(self,self.parameters)
 
+    @affine
     def W_to_base(self,watts):
         #here is the calibration code that may use self.parameters
         vpp = float(watts - self.parameters['int'])/self.parameters['grad']
         return vpp
+    @affine
     def W_from_base(self,vpp):
         #here is the calibration code that may use self.parameters
         watts = self.parameters['grad']*vpp + self.parameters['int']
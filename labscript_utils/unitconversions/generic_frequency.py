@@ -29,26 +29,32 @@ class FreqConversion(UnitConversion):
             self.derived_units = ['kHz', 'MHz', 'GHz']
         UnitConversion.__init__(self,self.parameters)
     
+    @affine
     def kHz_to_base(self,kHz):
         Hz = kHz*1e3
         return Hz
 
+    @affine
     def kHz_from_base(self,Hz):
         kHz = Hz*1e-3
         return kHz
 
+    @affine
     def MHz_to_base(self,MHz):
         Hz = MHz*1e6
         return Hz
 
+    @affine
     def MHz_from_base(self,Hz):
         MHz = Hz*1e-6
         return MHz
 
+    @affine
     def GHz_to_base(self,GHz):
         Hz = GHz*1e9
         return Hz
 
+    @affine
     def GHz_from_base(self,Hz):
         GHz = Hz*1e-9
         return GHz
\ No newline at end of file
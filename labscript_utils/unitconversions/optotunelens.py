@@ -12,7 +12,7 @@
 #####################################################################
 from .UnitConversionBase import *
 from scipy.special import lambertw
-from numpy import exp, abs
+from numpy import exp, abs, clip
 class OptotuneLens(UnitConversion):
     base_unit = 'V'
     derived_units = ['distance','I']
@@ -50,7 +50,7 @@ class OptotuneLens(UnitConversion):
         return (volts > 0) * abs(volts)
         
     def distance_from_base(self,volts):
-        amps = max(min(self.parameters['current_cal'] * volts,self.parameters['I_Max']),0)
+        amps = clip(self.parameters['current_cal'] * volts, 0, self.parameters['I_Max'])
         
         percentage = self.parameters['a']*exp(self.parameters['b']*amps) + self.parameters['c']*amps - self.parameters['a']
         
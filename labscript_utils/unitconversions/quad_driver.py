@@ -11,6 +11,7 @@
 #                                                                   #
 #####################################################################
 from .UnitConversionBase import *
+import numpy as np
 
 class quad_driver(UnitConversion):
     base_unit = 'V'
@@ -26,18 +27,19 @@ class quad_driver(UnitConversion):
         
         UnitConversion.__init__(self,self.parameters)
 
-    @vectorise
     def A_to_base(self,amps):
-        V_min = (self.parameters['A_min'] - self.parameters['A_offset'])/self.parameters['A_per_V']
-        if amps < 0.001:
-            volts = 0
-        elif amps <= self.parameters['A_min']:
-            volts = V_min
-        else:
-            volts = (amps - self.parameters['A_offset'])/self.parameters['A_per_V']
-        return volts
+        # Evaluated on whole arrays at once. [()] converts 0d arrays back to scalars:
+        amps = np.asarray(amps, dtype=float)
+        A_min = self.parameters['A_min']
+        A_offset = self.parameters['A_offset']
+        A_per_V = self.parameters['A_per_V']
+        V_min = (A_min - A_offset)/A_per_V
+        volts = (amps - A_offset)/A_per_V
+        volts = np.select([amps < 0.001, amps <= A_min], [0.0, V_min], volts)
+        return volts[()]
     def A_from_base(self,volts):
-        amps = max(volts * self.parameters['A_per_V'] + self.parameters['A_offset'], self.parameters['A_min'])
+        amps = volts * self.parameters['A_per_V'] + self.parameters['A_offset']
+        amps = np.maximum(amps, self.parameters['A_min'])
         return amps
     def Gcm_to_base(self,gauss_per_cm):
         volts = self.A_to_base(gauss_per_cm/self.parameters['Gcm_per_A'])
@@ -24,15 +24,19 @@ class quad_monitor(UnitConversion):
         
         UnitConversion.__init__(self,self.parameters)
 
+    @affine
     def A_to_base(self,amps):
         volts = (amps - self.parameters['A_offset'])/self.parameters['A_per_V']
         return volts
+    @affine
     def A_from_base(self,volts):
         amps = volts * self.parameters['A_per_V'] + self.parameters['A_offset']
         return amps
+    @affine
     def Gcm_to_base(self,gauss_per_cm):
         volts = self.A_to_base(gauss_per_cm/self.parameters['Gcm_per_A'])
         return volts
+    @affine
     def Gcm_from_base(self,volts):
         gauss_per_cm = self.parameters['Gcm_per_A'] * self.A_from_base(volts)
         return gauss_per_cm
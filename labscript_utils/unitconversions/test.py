@@ -33,18 +33,22 @@ class test(UnitConversion):
         # We should probably also store some hardware limits here, and use them accordingly 
         # (or maybe load them from a globals file, or specify them in the connection table?)
 
+    @affine
     def A_to_base(self,amps):
         #here is the calibration code that may use self.parameters
         volts = amps/self.parameters['a']
         return volts
+    @affine
     def A_from_base(self,volts):
         #here is the calibration code that may use self.parameters
         amps = volts * self.parameters['a']
         return amps
+    @affine
     def Gauss_to_base(self,gauss):
         #here is the calibration code that may use self.parameters
         volts = gauss/self.parameters['b']
         return volts
+    @affine
     def Gauss_from_base(self,volts):
         #here is the calibration code that may use self.parameters
         gauss = (volts)*self.parameters['b']
@@ -17,15 +17,96 @@
     python -m labscript_utils.zlock [--daemon]
 
 If --daemon is specified, the zlock server will be started in the background.
+
+To instead print the round-trip latency of the configured zlock server, and the lock
+statistics published by processes run with the LABSCRIPT_ZLOCK_STATS environment
+variable set (see labscript_utils.ls_zprocess.LockMetrics), run:
+
+.. code-block:: bash
+
+    python -m labscript_utils.zlock --stats
 """
 import sys
 import subprocess
+from datetime import datetime
 from socket import gethostbyname
-from labscript_utils.ls_zprocess import get_config
+from labscript_utils.ls_zprocess import get_config, ProcessTree, LockMetrics
 from labscript_utils.setup_logging import LOG_PATH
 from zprocess import start_daemon
 
+N_PINGS = 20
+N_TOP_LOCKS = 20
+
+
+def print_stats():
+    config = get_config()
+    client = ProcessTree.instance().zlock_client
+    print('zlock server: %s:%s' % (config['zlock_host'], config['zlock_port']))
+    try:
+        # The first ping creates the socket, so don't count it:
+        client.ping()
+        latencies = sorted(client.ping() for _ in range(N_PINGS))
+        version = client.get_protocol_version()
+    except Exception as e:
+        print('  not responding: %s' % e)
+    else:
+        print('  protocol version: %s' % version)
+        print(
+            '  round trip (ms): min %.2f, median %.2f, max %.2f'
+            % (latencies[0], latencies[len(latencies) // 2], latencies[-1])
+        )
+
+    published = LockMetrics.load_published()
+    print()
+    if not published:
+        print('No lock statistics published. Set the LABSCRIPT_ZLOCK_STATS environment')
+        print('variable in the processes to be monitored.')
+        return
+    print('Lock statistics published by %d process(es):' % len(published))
+    for data in published:
+        print(
+            '  %s pid %s (%s), updated %s'
+            % (
+                data['host'],
+                data['pid'],
+                data['program'],
+                datetime.fromtimestamp(data['time']).strftime('%Y-%m-%d %H:%M:%S'),
+            )
+        )
+    merged = LockMetrics.merge(data['locks'] for data in published)
+    # Hottest locks first, by total time spent waiting for them:
+    keys = sorted(merged, key=lambda key: merged[key]['wait_total'], reverse=True)
+    print()
+    print(
+        '%8s %6s %10s %10s %10s %10s %8s  %s'
+        % ('acquired', 'failed', 'wait mean', 'wait max', 'hold mean', 'hold max',
+           'overheld', 'key')
+    )
+    for key in keys[:N_TOP_LOCKS]:
+        stats = merged[key]
+        n_waits = stats['acquisitions'] + stats['failures']
+        print(
+            '%8d %6d %9.1fms %9.1fms %9.1fms %9.1fms %8d  %s'
+            % (
+                stats['acquisitions'],
+                stats['failures'],
+                1000 * stats['wait_total'] / max(n_waits, 1),
+                1000 * stats['wait_max'],
+                1000 * stats['hold_total'] / max(stats['acquisitions'], 1),
+                1000 * stats['hold_max'],
+                stats['overheld'],
+                key,
+            )
+        )
+    if len(keys) > N_TOP_LOCKS:
+        print('(%d more keys not shown)' % (len(keys) - N_TOP_LOCKS))
+
+
 def main():
+    if '--stats' in sys.argv:
+        print_stats()
+        return
+
     config = get_config()
 
     if gethostbyname(config['zlock_host']) != gethostbyname('localhost'):